@@ -1,12 +1,26 @@
 import math
 import Tkinter
 import PIL.ImageColor as imgColor
+import PIL.ImageTk
+from collections import defaultdict
+
+#Tk color strings by color name
+_colors={}
+
+def tk_color(name):
+    """Return the Tk '#rrggbb' string for a color name, memoized"""
+    try:
+        return _colors[name]
+    except KeyError:
+        _colors[name]="#%02x%02x%02x" % imgColor.getrgb(name)[:3]
+        return _colors[name]
 
 class BetterCanvas(Tkinter.Canvas):
     def __init__(self, parent, width, height, units_hwidth, units_hheight, bg='White'):
         
         Tkinter.Canvas.__init__(self, parent, width=width, height=height, bg=bg)
         self.parent=parent
+        self.bg=bg
          
         self.centerx=float(width)/2.0
         self.centery=float(height)/2.0
@@ -14,43 +28,161 @@ class BetterCanvas(Tkinter.Canvas):
         self.scalex=self.centerx/units_hwidth
         self.scaley=self.centery/units_hheight
         
+        #Retained mode state, items of the last frame by key and the items
+        # drawn so far in the current frame, values are (item, coords, options)
+        self._retained={}
+        self._frame=None
+        self._nanon=defaultdict(int)
+        #Items in the order they were drawn in the last and current frames
+        self._stacking=[]
+        self._order=None
+        
+        #Image item under everything else and the PIL image it shows
+        self._background=None
+        self._backgroundImage=None
+        self._backgroundPhoto=None
+        
         #Register onResize so it gets called if the canvas window is resized
 
     def clear(self):
         self.delete(Tkinter.ALL)
+        self._background=None
+        self._backgroundImage=None
+        self._retained={}
+        self._stacking=[]
+        if self._frame is not None:
+            self._frame={}
+            self._order=[]
+
+    def beginFrame(self):
+        """
+        Start drawing a frame in retained mode. Until endFrame is called each
+        draw call reuses the canvas item drawn with the same key in the last
+        frame, only changing its coordinates or options if they differ. Items
+        drawn without a key are matched by drawing order.
+        """
+        self._frame={}
+        self._order=[]
+        self._nanon.clear()
+
+    def endFrame(self):
+        """
+        Finish the frame, deleting last frame's items that weren't redrawn and
+        stacking the items in the order they were drawn
+        """
+        for key, (item, _, _) in self._retained.iteritems():
+            if key not in self._frame:
+                self.delete(item)
+        #Reused items keep their place and new ones go on top, so unless the
+        # items were drawn in the same order as last frame restack them all
+        if self._order!=self._stacking:
+            for item in self._order:
+                self.tag_raise(item)
+        self._stacking=self._order
+        self._retained=self._frame
+        self._frame=None
+        self._order=None
+
+    def drawBackground(self, image):
+        """
+        Show a PIL image the size of the canvas below all other items, in
+        place of the previous background image
+        """
+        if image is self._backgroundImage:
+            return
+        self._backgroundImage=image
+        self._backgroundPhoto=PIL.ImageTk.PhotoImage(image)
+        if self._background is None:
+            self._background=self.create_image(0, 0, anchor=Tkinter.NW,
+                                               image=self._backgroundPhoto)
+        else:
+            self.itemconfig(self._background, image=self._backgroundPhoto)
+        self.tag_lower(self._background)
+
+    def _draw(self, kind, coords, kw, key=None):
+        """Create or, in retained mode, update a canvas item"""
+        if self._frame is None:
+            return getattr(self, 'create_'+kind)(*coords, **kw)
+        
+        if key is None:
+            key=(kind, self._nanon[kind])
+            self._nanon[kind]+=1
+        else:
+            key=(kind, key)
+            if key in self._frame:
+                #Drawn more than once in the frame
+                self._nanon[key]+=1
+                key=key+(self._nanon[key],)
+        
+        old=self._retained.get(key)
+        if old is None or set(old[2])!=set(kw):
+            if old is not None:
+                self.delete(old[0])
+            item=getattr(self, 'create_'+kind)(*coords, **kw)
+        else:
+            item, oldcoords, oldkw=old
+            if coords!=oldcoords:
+                self.coords(item, *coords)
+            changed={k:v for k,v in kw.iteritems() if oldkw[k]!=v}
+            if changed:
+                self.itemconfig(item, changed)
+        self._frame[key]=(item, coords, kw)
+        self._order.append(item)
+        return item
 
     def onResize(self):
         pass
     
     def sanitizeColorKW(self, kwdict):	
         for k in ['color','fill','background','outline','bg']:
-            if k in kwdict and kwdict[k]!=None:
-                tkcol="#%02x%02x%02x" % imgColor.getrgb(kwdict[k])
-                kwdict[k]=tkcol
+            #None is the default color and '' transparent, as in Tk
+            if k in kwdict and kwdict[k]:
+                kwdict[k]=tk_color(kwdict[k])
         
     def drawCircle(self, (x,y), r, **kw):
         x1=self.canvasCoordx(x-r)
         x2=self.canvasCoordx(x+r)
         y1=self.canvasCoordy(y+r)
         y2=self.canvasCoordy(y-r)
+        key=kw.pop('key', None)
+        self.sanitizeColorKW(kw)
+        return self._draw('oval', (x1,y1,x2,y2), kw, key=key)
+
+    def drawCircles(self, points, r, keys=None, **kw):
+        """
+        Draw circles of radius r centered on each of points with the same
+        options, keys are the retained mode keys for each circle. Returns the
+        list of items.
+        """
         self.sanitizeColorKW(kw)
-        self.create_oval(x1,y1,x2,y2, kw)
+        if keys is None:
+            keys=[None]*len(points)
+        items=[]
+        for (x,y), key in zip(points, keys):
+            items.append(self._draw('oval', (self.canvasCoordx(x-r),
+                                             self.canvasCoordy(y+r),
+                                             self.canvasCoordx(x+r),
+                                             self.canvasCoordy(y-r)),
+                                    kw, key=key))
+        return items
 
     def drawSquare(self,(x,y), len, **kw):
+        key=kw.pop('key', None)
         self.sanitizeColorKW(kw)
-        self.create_rectangle(
-              self.canvasCoordx(x-len/2.),
-              self.canvasCoordy(y-len/2.),  
-              self.canvasCoordx(x+len/2.),  
-              self.canvasCoordy(y+len/2.), kw)
+        return self._draw('rectangle',
+                          (self.canvasCoordx(x-len/2.),
+                           self.canvasCoordy(y-len/2.),
+                           self.canvasCoordx(x+len/2.),
+                           self.canvasCoordy(y+len/2.)), kw, key=key)
 
     def drawRectangle(self,(x0,y0,x1,y1), **kw):
+        key=kw.pop('key', None)
         self.sanitizeColorKW(kw)
-        self.create_rectangle(
-              self.canvasCoordx(x0),
-              self.canvasCoordy(y0),  
-              self.canvasCoordx(x1),  
-              self.canvasCoordy(y1), kw)  
+        return self._draw('rectangle',
+                          (self.canvasCoordx(x0),
+                           self.canvasCoordy(y0),
+                           self.canvasCoordx(x1),
+                           self.canvasCoordy(y1)), kw, key=key)
 
     def drawDashedLine(self, *args, **kw):
         
@@ -60,6 +192,7 @@ class BetterCanvas(Tkinter.Canvas):
     def drawLine(self, *args, **kw):
         assert len(args) == 2 or len(args) == 3
 
+        key=kw.pop('key', None)
         self.sanitizeColorKW(kw)
         pos0 = args[0]
         if len(args) == 2:
@@ -74,18 +207,48 @@ class BetterCanvas(Tkinter.Canvas):
         if kw.pop('dashing',None):
             kw['dash']=(3,3)
 
-        self.create_line(self.canvasCoordx(pos0[0]),
-                         self.canvasCoordy(pos0[1]),
-                         self.canvasCoordx(pos1[0]),
-                         self.canvasCoordy(pos1[1]),kw)
+        return self._draw('line',
+                          (self.canvasCoordx(pos0[0]),
+                           self.canvasCoordy(pos0[1]),
+                           self.canvasCoordx(pos1[0]),
+                           self.canvasCoordy(pos1[1])), kw, key=key)
 
 
-    def drawText(self,(x,y),text,color=None, center=0):
+    def drawLines(self, segments, **kw):
+        """
+        Draw the line segments ((x0,y0), (x1,y1)) of segments with the same
+        options. Returns the list of items.
+        """
+        key=kw.pop('key', None)
+        self.sanitizeColorKW(kw)
+        items=[]
+        for i, ((x0,y0), (x1,y1)) in enumerate(segments):
+            items.append(self._draw('line', (self.canvasCoordx(x0),
+                                             self.canvasCoordy(y0),
+                                             self.canvasCoordx(x1),
+                                             self.canvasCoordy(y1)),
+                                    kw, key=None if key is None else (key, i)))
+        return items
+
+    def drawPolyline(self, points, **kw):
+        """Draw connected line segments through each of points as one item"""
+        if len(points) < 2:
+            return
+        key=kw.pop('key', None)
+        self.sanitizeColorKW(kw)
+        if kw.pop('dashing',None):
+            kw['dash']=(3,3)
+        coords=[]
+        for x,y in points:
+            coords.append(self.canvasCoordx(x))
+            coords.append(self.canvasCoordy(y))
+        return self._draw('line', tuple(coords), kw, key=key)
+
+    def drawText(self,(x,y),text,color=None, center=0, key=None):
         kw={'color':color}
         self.sanitizeColorKW(kw)
-        self.create_text(self.canvasCoordx(x),
-                         self.canvasCoordy(y),
-                         text=text,fill=kw['color'])
+        return self._draw('text', (self.canvasCoordx(x), self.canvasCoordy(y)),
+                          {'text':text, 'fill':kw['color']}, key=key)
          
     
     def canvasCoordx(self,x):
@@ -93,3 +256,9 @@ class BetterCanvas(Tkinter.Canvas):
     
     def canvasCoordy(self,y):
         return round(-self.scaley*y+self.centery)
+
+    def inputCoordx(self, x):
+        return (self.centerx-x)/self.scalex
+
+    def inputCoordy(self, y):
+        return (self.centery-y)/self.scaley
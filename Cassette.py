@@ -118,12 +118,21 @@ cassette_positions=_init_cassette_positions()
 
 
 class Cassette(object):
-    def __init__(self, name, slit, usable=None):
+    def __init__(self, name, slit, usable=None, mask=None):
+        """
+        mask is an optional boolean array of length N_FIBERS, true for usable
+        fibers (element 0 is fiber 1), it is used directly, not copied, so the
+        cassette may be given a row of a setup's fiber mask.
+        """
         assert 'h' in name or 'l' in name
-        if usable == None and 'h' in name:
-            self.usable=range(9,17)
-        elif usable == None and 'l' in name:
-            self.usable=range(1,9)
+        if mask is not None:
+            self.mask=mask
+        elif usable == None:
+            self.mask=np.zeros(N_FIBERS, dtype=bool)
+            if 'h' in name:
+                self.mask[8:]=True
+            else:
+                self.mask[:8]=True
         else:
             self.usable=usable
         self.name=name
@@ -135,6 +144,16 @@ class Cassette(object):
         self._slit=defaultdict(lambda:self._defaultslit)
         self.holes=[]
     
+    @property
+    def usable(self):
+        """List of usable fiber numbers"""
+        return (np.flatnonzero(self.mask)+1).tolist()
+
+    @usable.setter
+    def usable(self, fibers):
+        self.mask=np.zeros(N_FIBERS, dtype=bool)
+        self.mask[np.array(fibers, dtype=int)-1]=True
+
     def slit(self,setup):
         return self._slit[setup]
     
@@ -157,11 +176,11 @@ class Cassette(object):
         return [self.map[fiber] for fiber in sorted(self.map.keys())]
 
     def n_avail(self):
-        return len(self.usable)-self.used
+        return int(self.mask.sum())-self.used
     
     def consume(self):
         self.used+=1
-        assert self.used <= len(self.usable)
+        assert self.used <= self.mask.sum()
     
     def reset(self):
         self.used=0
@@ -177,7 +196,6 @@ class Cassette(object):
     def assign_hole(self, hole):
         """Add the hole to the cassette and assign the cassette to the hole"""
         if self.n_avail()==0:
-            import pdb;pdb.set_trace()
             raise Exception('Cassette Full')
 
         if not self.slit_compatible(hole):
@@ -186,7 +204,10 @@ class Cassette(object):
             print "assigning hole with preset fiber"
             if fiber2cassettename(hole['FIBER'])!=self.name:
                 raise ValueError('Hole not compatible with cassette')
-            self.map[int(hole['FIBER'].split('-')[1])]=hole
+            fnum=int(hole['FIBER'].split('-')[1])
+            if not self.mask[fnum-1]:
+                raise ValueError('Fiber {} is not usable'.format(hole['FIBER']))
+            self.map[fnum]=hole
             self._slit[hole['SETUP']]=hole['SLIT']
         else:
             hole.assign_cassette(self.name)
@@ -198,7 +219,6 @@ class Cassette(object):
         Remove the hole from the cassette and unassign cassette from the hole
         """
         if hole not in self.holes:
-            import pdb;pdb.set_trace()
             raise Exception('Hole not in cassette')
         self.used-=1
         self.holes.remove(hole)
@@ -215,9 +235,8 @@ class Cassette(object):
         #min of self.usable not in self.map
         free=filter(lambda x: x not in self.map, self.usable)
         
-        #assert len(free)>0
         if len(free)==0:
-            import ipdb;ipdb.set_trace()
+            raise Exception('No free fiber in cassette {}'.format(self.name))
         
         num=min(free)
         
@@ -261,6 +280,30 @@ def blue_cassette_names():
 def red_cassette_names():
     return ['R'+str(i)+j for i in range(1,9) for j in 'hl']
 
-def new_cassette_dict(slitwid=180):
-    return {side+str(i)+j: Cassette(side+str(i)+j, slitwid)
-    for side in 'RB' for i in range(1,9) for j in 'hl'}
+#Row order of fiber masks, a mask has a row for each cassette and a column
+# for each fiber number
+CASSETTE_NAMES=red_cassette_names()+blue_cassette_names()
+CASSETTE_INDEX={name:i for i,name in enumerate(CASSETTE_NAMES)}
+N_FIBERS=16
+
+def default_fiber_mask():
+    """
+    Return a len(CASSETTE_NAMES) x N_FIBERS boolean mask with fibers 1-8 of
+    the l cassettes and 9-16 of the h cassettes usable
+    """
+    mask=np.zeros((len(CASSETTE_NAMES), N_FIBERS), dtype=bool)
+    low=np.array(['l' in name for name in CASSETTE_NAMES])
+    mask[low, :8]=True
+    mask[~low, 8:]=True
+    return mask
+
+def new_cassette_dict(slitwid=180, mask=None):
+    """
+    Return a dict of all the cassettes. If mask, a fiber mask, is given the
+    cassettes use its rows as their usable fibers.
+    """
+    if mask is None:
+        return {side+str(i)+j: Cassette(side+str(i)+j, slitwid)
+                for side in 'RB' for i in range(1,9) for j in 'hl'}
+    return {name: Cassette(name, slitwid, mask=mask[CASSETTE_INDEX[name]])
+            for name in CASSETTE_NAMES}
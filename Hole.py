@@ -27,6 +27,8 @@ class Hole(dict):
                                  for c in Cassette.cassette_positions}
         self.hash=self.__hash__()
         
+        #.plate files give the slit as a string
+        slit=int(slit)
         assert slit in (180, 125, 95, 75, 58, 45)
 
         #ID processing
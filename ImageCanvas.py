@@ -1,22 +1,109 @@
 import PIL.Image
+import PIL.ImageChops
 import PIL.ImageDraw
 import PIL.ImageFont
 #import PIL.ImageFilter
 import math
+import numpy as np
+
+LABEL_FONT="Arial.ttf"
+
+#Rows of the finished image rendered at a time and the rows of context
+# rendered above and below each tile for the downsampling filter
+TILE_ROWS=160
+TILE_MARGIN=3
+
+#Loaded fonts by (path, size) and rendered text masks by (path, size, text)
+_fonts={}
+_glyphs={}
+#Ellipse fill and outline masks by size and colored ellipses by size & colors
+_ellipses={}
+_stamps={}
+
+def get_font(path, size):
+    """
+    Return the truetype font at path in size, loading it only once. A path of
+    None is PIL's default bitmap font.
+    """
+    key=(path, size)
+    if key not in _fonts:
+        if path is None:
+            _fonts[key]=PIL.ImageFont.load_default()
+        else:
+            _fonts[key]=PIL.ImageFont.truetype(path, size)
+    return _fonts[key]
+
+def get_text_mask(path, size, text):
+    """Return an 'L' image of text rendered in the font, reused for repeats"""
+    key=(path, size, text)
+    if key not in _glyphs:
+        font=get_font(path, size)
+        mask=PIL.Image.new('L', font.getsize(text))
+        PIL.ImageDraw.Draw(mask).text((0,0), text, fill=255, font=font)
+        _glyphs[key]=mask
+    return _glyphs[key]
+
+def _round(x):
+    """Round half away from zero, as round does, for scalars or arrays"""
+    return np.copysign(np.floor(np.abs(x)+0.5), x)
+
+def get_ellipse_masks(width, height, line_width=1):
+    """
+    Return 'L' images of the interior and the outline of the ellipse drawn by
+    ImageDraw.ellipse in a box (0, 0, width, height)
+    """
+    key=(width, height, line_width)
+    if key not in _ellipses:
+        fill=PIL.Image.new('L', (width+1, height+1))
+        PIL.ImageDraw.Draw(fill).ellipse((0,0,width,height), fill=255)
+        outline=PIL.Image.new('L', (width+1, height+1))
+        PIL.ImageDraw.Draw(outline).ellipse((0,0,width,height), outline=255,
+                                            width=line_width)
+        _ellipses[key]=(fill, outline)
+    return _ellipses[key]
+
+def get_ellipse_stamp(width, height, line_width, outline, fill):
+    """
+    Return an 'RGB' image of the ellipse drawn by ImageDraw.ellipse in a box
+    (0, 0, width, height) with outline and fill, either may be None, and the
+    'L' mask of its pixels, so it can be drawn with a single paste
+    """
+    key=(width, height, line_width, outline, fill)
+    if key not in _stamps:
+        fillmask, outlinemask=get_ellipse_masks(width, height, line_width)
+        if outline is None or outline == fill:
+            image=PIL.Image.new('RGB', fillmask.size, fill)
+            mask=fillmask
+        elif fill is None:
+            image=PIL.Image.new('RGB', fillmask.size, outline)
+            mask=outlinemask
+        else:
+            image=PIL.Image.new('RGB', fillmask.size, fill)
+            image.paste(outline, (0, 0), outlinemask)
+            mask=PIL.ImageChops.lighter(fillmask, outlinemask)
+        _stamps[key]=(image, mask)
+    return _stamps[key]
 
 class ImageCanvas():
-    def __init__(self, width, height, units_hwidth, units_hheight):
+    """
+    Draws to an image for the projector. Drawing is recorded in a display
+    list in supersampled pixels, and rendered in horizontal tiles of the
+    supersampled image which are downsampled into the finished image, so the
+    whole supersampled image is never held in memory.
+    """
+    def __init__(self, width, height, units_hwidth, units_hheight, bg=None):
     
         #http://www.pythonware.com/library/pil/handbook/imagedraw.htm for ref
-        #create a new image filled black
+        #images are filled with bg, black by default
+        self.bg=bg or 'Black'
         self.mult=4
         self.lwid=int(self.mult+3)
 
         self.default_color='White'
         self.finishedSize=(width,height)
         
-        self.image= PIL.Image.new("RGB", (self.mult*width, self.mult*height))
-        self.draw = PIL.ImageDraw.Draw(self.image)
+        #Display list of (ymin, ymax, render function, args)
+        self.ops=[]
         
         self.centerx=self.mult*float(width)/2.0
         self.centery=self.mult*float(height)/2.0
@@ -25,14 +112,34 @@ class ImageCanvas():
         self.scaley=self.centery/units_hheight
         
         
-    def save(self, file):
-        #im=self.image.filter(PIL.ImageFilter.SMOOTH)
-        im=self.image.resize(self.finishedSize,PIL.Image.ANTIALIAS)
-        im.save(file)
+    def save(self, file, **options):
+        """Save the rendered image, options are passed to PIL's Image.save"""
+        self.render().save(file, **options)
+
+
+    def render(self):
+        """Render the display list and return the finished image"""
+        width,height=self.finishedSize
+        out=PIL.Image.new("RGB", self.finishedSize, self.bg)
+        for row in xrange(0, height, TILE_ROWS):
+            rows=min(TILE_ROWS, height-row)
+            tilesize=(width, rows+2*TILE_MARGIN)
+            tile=PIL.Image.new("RGB", (self.mult*tilesize[0],
+                                       self.mult*tilesize[1]), self.bg)
+            top=self.mult*(row-TILE_MARGIN)
+            bottom=top+tile.size[1]
+            draw=PIL.ImageDraw.Draw(tile)
+            for ymin, ymax, func, args in self.ops:
+                if ymax >= top and ymin < bottom:
+                    func(tile, draw, top, *args)
+            tile=tile.resize(tilesize, PIL.Image.ANTIALIAS)
+            out.paste(tile.crop((0, TILE_MARGIN, width, TILE_MARGIN+rows)),
+                      (0, row))
+        return out
 
 
     def clear(self):
-        pass
+        self.ops=[]
 
 
     def setupColors(self, outline, fill):
@@ -54,14 +161,45 @@ class ImageCanvas():
         p2=( self.canvasCoordx(x+r),
              self.canvasCoordy(y+r) )
         if p1[0] > p2[0]:
-            l=[p2,p1]
+            l=(p2[0],p2[1],p1[0],p1[1])
         else:
-            l=[p1,p2]
+            l=(p1[0],p1[1],p2[0],p2[1])
                 
         #Sort out coloring
         col=self.setupColors(outline, fill)
 
-        self.draw.ellipse(l, outline=col[0], fill=col[1])
+        self.ops.append((l[1], l[3], _render_ellipse, (l, col[0], col[1])))
+
+
+    def drawCircles(self, points, r, fill=None, outline=None, width=None):
+        """
+        Draw circles of radius r centered on each of points, width is the
+        outline width in pixels of the finished image
+        """
+        if not len(points):
+            return
+        points=np.asarray(points, dtype=float)
+        
+        # Get the coordinates, same as drawCircle
+        boxes=np.empty((len(points), 4))
+        boxes[:,0]=self.canvasCoordx(points[:,0]+r)
+        boxes[:,1]=self.canvasCoordy(points[:,1]+r)
+        boxes[:,2]=self.canvasCoordx(points[:,0]-r)
+        boxes[:,3]=self.canvasCoordy(points[:,1]-r)
+        if r < 0:
+            boxes=boxes[:,[2,3,0,1]]
+        boxes=boxes.astype(int)
+        
+        #Sort out coloring
+        col=self.setupColors(outline, fill)
+        
+        if width:
+            lw=int(round(width*self.mult))
+        else:
+            lw=1
+        
+        self.ops.append((boxes[:,1].min(), boxes[:,3].max(), _render_ellipses,
+                         (boxes, col[0], col[1], lw)))
 
 
     #x,y are at center len is length of side
@@ -76,7 +214,8 @@ class ImageCanvas():
         #Sort out coloring
         col=self.setupColors(outline, fill)
         
-        self.draw.rectangle((x0,y0,x1,y1), outline=col[0], fill=col[1])
+        self.ops.append((min(y0,y1), max(y0,y1), _render_rectangle,
+                         ((x0,y0,x1,y1), col[0], col[1])))
         
 
     # x0,y0 is one corner, x1,y1 is corner diagonally across
@@ -95,7 +234,8 @@ class ImageCanvas():
         # defines a point just outside the rectangle, also
         # when the rectangle is not filled.
         # Not sure if this will be an issue
-        self.draw.rectangle((x0c,y0c,x1c,y1c), outline=col[0], fill=col[1])
+        self.ops.append((min(y0c,y1c), max(y0c,y1c), _render_rectangle,
+                         ((x0c,y0c,x1c,y1c), col[0], col[1])))
         
     ##takes either (x0,y0), (x1,y1)  or (x,y), r,theta
     def drawLine(self, *args, **kw):
@@ -128,27 +268,58 @@ class ImageCanvas():
                 xi,yi=x0c,y0c
                 xf,yf=x1c,y1c
             llen=math.hypot(xf-xi, yf-yi)
-            
-            notdone=True
-            x0,y0=xi,yi
             dl=20
-            dx,dy=dl*(xf-xi)/llen,dl*(yf-yi)/llen
-
-            x1,y1=x0+dx,y0+dy
-            if x1 < xf:
-                while notdone:
-                    
-                    self.draw.line((x0,y0,x1,y1), fill=col[0],width=self.lwid)
-                    x0,y0=x1+dx,y1+dy
-                    x1,y1=x0+dx,y0+dy
-                    if x1 > xf:
-                        self.draw.line((x0,y0,xf,yf), fill=col[0],width=self.lwid)
-                        notdone=False
-            else:    
-                self.draw.line((x0c,y0c,x1c,y1c), fill=col[0],width=self.lwid)
-                
+            
+            if xf > xi and llen > dl:
+                #Dashes of length dl every 2*dl along the line
+                start=np.arange(0, llen, 2*dl)
+                end=np.minimum(start+dl, llen)
+                ux,uy=(xf-xi)/llen, (yf-yi)/llen
+                segments=np.column_stack((xi+start*ux, yi+start*uy,
+                                          xi+end*ux, yi+end*uy)).tolist()
+            else:
+                segments=[(x0c,y0c,x1c,y1c)]
         else:
-            self.draw.line((x0c,y0c,x1c,y1c), fill=col[0],width=self.lwid)
+            segments=[(x0c,y0c,x1c,y1c)]
+        
+        self.ops.append((min(y0c,y1c)-self.lwid, max(y0c,y1c)+self.lwid,
+                         _render_lines, (segments, col[0], self.lwid)))
+
+
+    def drawLines(self, segments, fill=None):
+        """Draw the line segments ((x0,y0), (x1,y1)) of segments"""
+        if not len(segments):
+            return
+        xy=np.asarray(segments, dtype=float).reshape(-1, 2)
+        
+        # Get the coordinates
+        xy=np.column_stack((self.canvasCoordx(xy[:,0]),
+                            self.canvasCoordy(xy[:,1]))).reshape(-1, 4)
+        
+        #Sort out coloring
+        col=self.setupColors(fill, None)
+        
+        self.ops.append((xy[:,[1,3]].min()-self.lwid,
+                         xy[:,[1,3]].max()+self.lwid,
+                         _render_lines, (xy.tolist(), col[0], self.lwid)))
+
+
+    def drawPolyline(self, points, fill=None):
+        """Draw connected line segments through each of points"""
+        if len(points) < 2:
+            return
+        points=np.asarray(points, dtype=float)
+        
+        # Get the coordinates
+        xy=np.empty(points.shape)
+        xy[:,0]=self.canvasCoordx(points[:,0])
+        xy[:,1]=self.canvasCoordy(points[:,1])
+        
+        #Sort out coloring
+        col=self.setupColors(fill, None)
+        
+        self.ops.append((xy[:,1].min()-self.lwid, xy[:,1].max()+self.lwid,
+                         _render_polyline, (xy, col[0], self.lwid)))
 
 
     # x,y is at upper left corner of text unless center is set to 1
@@ -158,30 +329,31 @@ class ImageCanvas():
         xc=self.canvasCoordx(x)
         yc=self.canvasCoordy(y)
 
-        thefont=PIL.ImageFont.truetype("Arial.ttf", 12*self.mult)
+        mask=get_text_mask(LABEL_FONT, 12*self.mult, text)
 
         if center:
-            tmp=thefont.getsize(text)
+            tmp=mask.size
             xc-=tmp[0]/2.0
             yc-=tmp[0]/2.0
 
         #Sort out coloring
         col=self.setupColors(color, None)
 
-        self.draw.text((xc,yc), text, fill=col[0], font=thefont)
+        self.ops.append((yc, yc+mask.size[1], _render_text,
+                         ((xc,yc), mask, col[0])))
         
     def getTextSize(self,text):
-        wid,ht=self.draw.textsize(text)
+        wid,ht=get_font(None, None).getsize(text)
         return ( self.inputCoordx(wid)-self.inputCoordx(0), 
                  self.inputCoordy(ht)-self.inputCoordy(0) )
 
     # go from coordinates with 0,0 at center to 0,0 at upper left
     def canvasCoordx(self, x):
-        return round(-self.scalex*x+self.centerx)
+        return _round(-self.scalex*x+self.centerx)
 
 
     def canvasCoordy(self, y):
-        return round(-self.scaley*y + self.centery)
+        return _round(-self.scaley*y + self.centery)
 
     def inputCoordx(self, x):
         return (self.centerx-x)/self.scalex
@@ -189,3 +361,35 @@ class ImageCanvas():
     def inputCoordy(self, y):
         return (self.centery-y)/self.scaley
 
+
+#Render functions for the display list, called with the tile image, a Draw
+# for it, and the row of the supersampled image at the top of the tile
+
+def _render_ellipse(tile, draw, top, (x0,y0,x1,y1), outline, fill):
+    draw.ellipse((x0,y0-top,x1,y1-top), outline=outline, fill=fill)
+
+def _render_ellipses(tile, draw, top, boxes, outline, fill, line_width):
+    """
+    Paste a precomputed ellipse stamp for each of boxes within the tile in
+    drawing order, each paste touches only the pixels of its box
+    """
+    if fill is None and outline is None:
+        return
+    boxes=boxes[(boxes[:,3] >= top) & (boxes[:,1] < top+tile.size[1])]
+    boxes[:,[1,3]]-=top
+    for x0,y0,x1,y1 in boxes.tolist():
+        image, mask=get_ellipse_stamp(x1-x0, y1-y0, line_width, outline, fill)
+        tile.paste(image, (x0, y0), mask)
+
+def _render_rectangle(tile, draw, top, (x0,y0,x1,y1), outline, fill):
+    draw.rectangle((x0,y0-top,x1,y1-top), outline=outline, fill=fill)
+
+def _render_lines(tile, draw, top, segments, fill, width):
+    for x0,y0,x1,y1 in segments:
+        draw.line((x0,y0-top,x1,y1-top), fill=fill, width=width)
+
+def _render_polyline(tile, draw, top, xy, fill, width):
+    draw.line((xy-(0,top)).ravel().tolist(), fill=fill, width=width)
+
+def _render_text(tile, draw, top, (x,y), mask, fill):
+    draw.bitmap((x,y-top), mask, fill=fill)
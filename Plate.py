@@ -5,10 +5,16 @@ Created on Dec 12, 2009
 '''
 from Hole import *
 import ImageCanvas
-from plateHoleInfo import plateHoleInfo
+from plateHoleInfo import plateHoleInfo, InfeasibleSetup
 import operator
+import math
 import Cassette
 import os.path
+import numpy as np
+from collections import OrderedDict
+import weakref
+import threading
+import copy
 
 def distribute(x, min_x, max_x, min_sep):
     """
@@ -120,6 +126,18 @@ MIN_LABEL_Y_SEP=0.05 #must be < 2*LABEL_MAX_Y/16
 
 PROJ_PLATE_LABEL_Y=.95
 
+#Number of coordinate shift settings to keep shifted hole positions for
+SHIFT_CACHE_SIZE=4
+#Number of background images of inactive holes cached
+BACKGROUND_CACHE_SIZE=8
+#Size of the cells of the grid used to find holes by position, plate units
+HIT_GRID_CELL=0.05
+
+
+class AssignmentCancelled(Exception):
+    """ Raised if a fiber assignment is cancelled while running """
+    pass
+
 class Plate(object):
     '''Class for fiber plug plate'''
     RADIUS=1.0 # 14.25/SCALE
@@ -138,37 +156,183 @@ class Plate(object):
         self.coordShift_R=50.68
         self.coordShift_rm=13.21875
         self.coordShift_a=0.03
+        #Shifted positions of all holes by hash, keyed by coord shift params
+        self._shiftCache=OrderedDict()
+        #Guards _shiftCache, the GUI draws the projector image in a thread
+        self._shiftLock=threading.Lock()
+        #Holes by hash and (coord shift key, grid, max radius) of the grid of
+        # hole hashes by shifted position, see _gridCells
+        self._holesByID={}
+        self._hitGrid=None
+        #(setups, setup names by hole hash, hashes of each setup's holes),
+        # see _setupIndex
+        self._setupIdx=None
+        #Rendered images of the holes not in a setup, see drawInactiveHoles
+        self._backgroundCache=OrderedDict()
+        #Canvas items drawn for each hole hash and the hole hash of each
+        # item by the last call to draw, per canvas
+        self._drawnHoles=weakref.WeakKeyDictionary()
+        self._drawnItems=weakref.WeakKeyDictionary()
+        #Hashes of the holes drawn into the background image by the last
+        # draw and the overlay items made for them, see getDrawnItems, per
+        # canvas
+        self._backgroundHoles=weakref.WeakKeyDictionary()
+        self._overlays=weakref.WeakKeyDictionary()
 
     def getHole(self, holeID):
-        for h in self.holeSet:
-            if h.hash == long(holeID):
-                return h
-        return None
+        if len(self._holesByID) != len(self.holeSet):
+            self._holesByID={h.hash:h for h in self.holeSet}
+        return self._holesByID.get(long(holeID))
+
+    def _gridCells(self):
+        """
+        Return the grid of (hash, x, y) of each hole by cell of its shifted
+        position and the largest hole radius, for the current coord shift
+        """
+        key=self.coordShiftKey()
+        if self._hitGrid is None or self._hitGrid[0]!=key:
+            grid={}
+            for hash, (hx,hy) in self._shiftedPositionDict().iteritems():
+                cell=(int(math.floor(hx/HIT_GRID_CELL)),
+                      int(math.floor(hy/HIT_GRID_CELL)))
+                grid.setdefault(cell, []).append((hash, hx, hy))
+            rmax=max([h.radius for h in self.holeSet] or [0.0])
+            self._hitGrid=(key, grid, rmax)
+        return self._hitGrid[1:]
+
+    def _gridSearch(self, grid, (x0,y0,x1,y1)):
+        """Yield the (hash, x, y) in the grid cells covering a rectangle"""
+        for i in xrange(int(math.floor(x0/HIT_GRID_CELL)),
+                        int(math.floor(x1/HIT_GRID_CELL))+1):
+            for j in xrange(int(math.floor(y0/HIT_GRID_CELL)),
+                            int(math.floor(y1/HIT_GRID_CELL))+1):
+                for entry in grid.get((i,j), ()):
+                    yield entry
+
+    def findHoles(self, (x,y), tolerance=0.0):
+        """
+        Return the holes whose shifted position is within their radius plus
+        tolerance of x,y, nearest first
+        """
+        grid, rmax=self._gridCells()
+        reach=rmax+tolerance
+        found=[]
+        for hash, hx, hy in self._gridSearch(grid, (x-reach, y-reach,
+                                                    x+reach, y+reach)):
+            hole=self.getHole(hash)
+            d=math.hypot(hx-x, hy-y)
+            if d <= hole.radius+tolerance:
+                found.append((d, hole))
+        found.sort(key=operator.itemgetter(0))
+        return [h for d, h in found]
+
+    def findHolesInRegion(self, (x0,y0,x1,y1)):
+        """
+        Return the holes whose shifted position is in the rectangle with
+        corners x0,y0 and x1,y1, as Hole.inRegion does for the unshifted
+        position. Holes are ordered top to bottom, then left to right.
+        """
+        left, right=min(x0,x1), max(x0,x1)
+        bottom, top=min(y0,y1), max(y0,y1)
+        grid, _=self._gridCells()
+        found=[(-hy, hx, hash) for hash, hx, hy in
+               self._gridSearch(grid, (left, bottom, right, top))
+               if left<=hx<=right and bottom<=hy<=top]
+        found.sort()
+        return [self.getHole(hash) for _, _, hash in found]
+
+    def getDrawnItems(self, canvas, holeID):
+        """
+        Return the items drawn on canvas for holeID by the last draw. A hole
+        drawn into the background image gets an overlay item, tagged as the
+        other holes are, that is invisible until hovered or disabled.
+        """
+        hash=long(holeID)
+        items=self._drawnHoles.get(canvas, {}).get(hash)
+        if items or not self.inBackground(canvas, hash):
+            return items or []
+        overlays=self._overlays.setdefault(canvas, {})
+        if hash not in overlays:
+            hole=self.getHole(hash)
+            overlays[hash]=canvas.drawCircle(self.shiftedPositions([hole])[0],
+                                hole.radius, outline='', fill='',
+                                tags=('hole', ".%i"%hash),
+                                disabledfill='Orange',
+                                disabledoutline='Orange')
+            self._drawnItems.setdefault(canvas, {})[overlays[hash]]=hash
+        return [overlays[hash]]
+
+    def inBackground(self, canvas, holeID):
+        """True if holeID was drawn into the background image of canvas"""
+        return long(holeID) in self._backgroundHoles.get(canvas, ())
+
+    def getDrawnHoleIDs(self, canvas, items):
+        """
+        Return the IDs, as strings, of the holes drawn on canvas as any of
+        items by the last draw. Items that aren't holes are ignored.
+        """
+        drawn=self._drawnItems.get(canvas, {})
+        return [str(drawn[i]) for i in items if i in drawn]
+
+    def _setupIndex(self):
+        """
+        Return a dict of the names of the setups using each hole by hole hash
+        and a dict of the set of hashes of the holes of each setup by name,
+        rebuilt when the setups change
+        """
+        if self._setupIdx is None or self._setupIdx[0] is not self.setups:
+            setupsByHole={}
+            targets={}
+            for k in self.setups:
+                v=self.setups[k]
+                targets[k]=set(h.hash for h in v['holes'])
+                for hash in targets[k].union(h.hash for h in v['unused_holes']):
+                    setupsByHole.setdefault(hash, []).append(k)
+            self._setupIdx=(self.setups, setupsByHole, targets)
+        return self._setupIdx[1:]
 
     def getSetupsUsingHole(self, hole):
-        ret=[]
-        for k in self.setups:
-            v=self.setups[k]
-            if hole in v['unused_holes'] or hole in v['holes']:
-                ret.append(k)
-        return ret
+        setupsByHole, _=self._setupIndex()
+        return list(setupsByHole.get(hole.hash, []))
 
-    def getHoleInfo(self, holeID):
+    def getHoleInfo(self, holeID, setupName=None):
         """
         Returns a dictionary of information for hole
             corresponding to holeID. Valid keys are:'RA',
             'DEC','ID','MAGNITUDE','COLOR','SETUPS',
-            'HOLEID', and 'TYPE'.
+            'HOLEID', and 'TYPE'. If setupName is a setup
+            'CHANNEL' and 'FIBER' are included, as returned
+            by getChannelForHole and getFiberForHole.
             An invalid holeID is an exception.
         """
-        hole=self.getHole(holeID)
-        if not hole:
-            raise Exception('Invalid holeID')
-        ret={'RA':hole.ra_string(),'DEC':hole.de_string(),
-             'ID':hole['ID'],'MAGNITUDE':hole['MAGNITUDE'],
-             'COLOR':hole['COLOR'],'TYPE':hole['TYPE'],
-             'SETUPS':self.getSetupsUsingHole(hole),'HOLEID':holeID,
-             'IDSTR':hole.idstr,'CUSTOM':hole['CUSTOM']}
+        return self.getHoleInfoBatch([holeID], setupName)[0]
+
+    def getHoleInfoBatch(self, holeIDs, setupName=None):
+        """
+        Returns a list of the getHoleInfo dictionaries for each of
+            holeIDs, including 'CHANNEL' and 'FIBER' if setupName
+            is a setup. The setups are indexed once for all the
+            holes. An invalid holeID is an exception.
+        """
+        setupsByHole, targets=self._setupIndex()
+        setupTargets=targets[setupName] if setupName in self.setups else None
+        ret=[]
+        for holeID in holeIDs:
+            hole=self.getHole(holeID)
+            if not hole:
+                raise Exception('Invalid holeID')
+            info={'RA':hole.ra_string(),'DEC':hole.de_string(),
+                  'ID':hole['ID'],'MAGNITUDE':hole['MAGNITUDE'],
+                  'COLOR':hole['COLOR'],'TYPE':hole['TYPE'],
+                  'SETUPS':list(setupsByHole.get(hole.hash, [])),
+                  'HOLEID':holeID,'IDSTR':hole.idstr,'CUSTOM':hole['CUSTOM']}
+            if setupTargets is not None:
+                color=None
+                if hole.hash in setupTargets:
+                    color=hole.assigned_color()
+                info['CHANNEL']=color if color!=None else ''
+                info['FIBER']=self._fiberForHole(hole)
+            ret.append(info)
         return ret
 
     def getChannelForHole(self, holeID, setupName):
@@ -181,10 +345,13 @@ class Plate(object):
             raise Exception('Invalid holeID')
         if setupName not in self.setups:
             raise Exception('Invalid setupName')
-        
+        return self._channelForHole(hole, setupName)
+
+    def _channelForHole(self, hole, setupName):
         ret=''
 
-        if hole in self.setups[setupName]['holes']:
+        _, targets=self._setupIndex()
+        if hole.hash in targets[setupName]:
             color=hole.assigned_color()
             if color !=None:
                 ret=color
@@ -203,7 +370,9 @@ class Plate(object):
             raise Exception('Invalid holeID')
         if setupName not in self.setups:
             raise Exception('Invalid setupName')
-        
+        return self._fiberForHole(hole)
+
+    def _fiberForHole(self, hole):
         if hole['FIBER'] !='':
             return hole['FIBER']
         else:
@@ -243,34 +412,78 @@ class Plate(object):
                 otherholes.append(h)
         return otherholes
 
-    def load(self,file):
+    def load(self,file, progress=None):
         ''' Routine to load holes from a file 
 
         File should have all the holes on the plate
         separated into groups specifying the setup number.
-        valid lines are of format x y z diam type arbit_fiber channel'''
+        valid lines are of format x y z diam type arbit_fiber channel
+        progress is passed on to plateHoleInfo'''
 
         if not os.path.isfile(file):
             return
         self.clear()
         
-        self.plateHoleInfo=plateHoleInfo(file)
+        self.plateHoleInfo=plateHoleInfo(file, progress=progress)
         self.plate_name=self.plateHoleInfo.name
         curr_setup=''
         
         self.holeSet=self.plateHoleInfo.holeSet
         self.setups=self.plateHoleInfo.setups
+        self._holesByID={h.hash:h for h in self.holeSet}
+        self._setupIdx=None
     
   
     def clear(self):
         self.setups={}
         self.holeSet=set()
-
-    def regionify(self, setup_number='1', awith=[]):
+        self._holesByID={}
+        self._hitGrid=None
+        self._setupIdx=None
+        with self._shiftLock:
+            self._shiftCache.clear()
+        self._backgroundCache.clear()
+
+    def regionify(self, setup_number='1', awith=[], progress=None,
+                  cancel=None):
         if 'Setup ' +setup_number in self.setups:
             if setup_number in awith:
                 awith.remove(setup_number)
-            self.assignFibers('Setup ' +setup_number, awith)
+            self.assignFibers('Setup ' +setup_number, awith,
+                              progress=progress, cancel=cancel)
+
+    def revalidateDeadFibers(self):
+        """
+        Apply changes to the dead fiber registry and redo the fiber
+        assignments of setups using a fiber which is now dead, along with the
+        setups they were assigned with. Setups with a preset fiber which is
+        now dead can't be reassigned and are left as they are. Returns the
+        names of the reassigned setups and a list of (setup name, hole) for
+        the preset holes on dead fibers.
+        """
+        affected=self.plateHoleInfo.revalidate_dead_fibers()
+        redone=[]
+        conflicts=[]
+        for setup_name in sorted(affected):
+            if setup_name in redone:
+                continue
+            awith=self.setups[setup_name]['INFO'].get('ASSIGNEDWITH', '')
+            awith=[s for s in awith.replace(' ','').split(',') if s]
+            group=[setup_name]+['Setup '+s for s in awith]
+            dead=[(s, h) for s in group
+                  for h in self.plateHoleInfo.dead_preset_holes(s)]
+            if dead:
+                conflicts.extend(dead)
+                continue
+            self.assignFibers(setup_name, awith)
+            redone.extend(group)
+        return redone, conflicts
+
+    def copyCoordShift(self, other):
+        """Use the coordinate shift settings of the Plate other"""
+        self.doCoordShift=other.doCoordShift
+        self.setCoordShift(D=other.coordShift_D, R=other.coordShift_R,
+                           rm=other.coordShift_rm, a=other.coordShift_a)
 
     def toggleCoordShift(self):
         self.doCoordShift = not self.doCoordShift
@@ -284,7 +497,35 @@ class Plate(object):
                 return False
         return True
 
-    def assignFibers(self, setup_name, awith):
+    def assignFibers(self, setup_name, awith, progress=None, cancel=None):
+        """
+        Assign fibers to the holes of setup_name and the setups in awith.
+        
+        progress is called as progress(stage, done, total) while holes are
+        assigned, with stage 'sky' or 'object'. If the threading.Event cancel
+        is set the assignment stops with AssignmentCancelled. If a hole can't
+        be assigned InfeasibleSetup is raised. On any exception the holes'
+        previous assignments are restored.
+        """
+        setup_names=[setup_name]+['Setup '+s for s in awith]
+        snapshot=[(h, h['FIBER'], copy.deepcopy(h['ASSIGNMENT']))
+                  for s in setup_names for h in self.setups[s]['holes']]
+        assignedwith=[(s, self.setups[s]['INFO'].get('ASSIGNEDWITH'))
+                      for s in setup_names]
+        try:
+            self._assignFibers(setup_name, awith, progress, cancel)
+        except:
+            for h, fiber, assignment in snapshot:
+                h['FIBER']=fiber
+                h['ASSIGNMENT']=assignment
+            for s, aw in assignedwith:
+                if aw is None:
+                    self.setups[s]['INFO'].pop('ASSIGNEDWITH', None)
+                else:
+                    self.setups[s]['INFO']['ASSIGNEDWITH']=aw
+            raise
+
+    def _assignFibers(self, setup_name, awith, progress, cancel):
         """
         load holes from file, by default assume all are on same slit and no pattern
         
@@ -377,7 +618,10 @@ class Plate(object):
         assigned=[h for h in setup['holes']+assignwithholes if h.isAssigned()]
         for h in assigned:
             print "some were assigned"
-            cassettes[Cassette.fiber2cassettename(h['FIBER'])].assign_hole(h)
+            try:
+                cassettes[Cassette.fiber2cassettename(h['FIBER'])].assign_hole(h)
+            except ValueError, e:
+                raise InfeasibleSetup('Could not plug {}: {}'.format(h, e))
         
         
 
@@ -394,8 +638,16 @@ class Plate(object):
                 group=cassette_groups[i % len(cassette_groups)]
                 h.assign_possible_cassette(group)
 
+        def step(stage, remaining, total):
+            if cancel is not None and cancel.is_set():
+                raise AssignmentCancelled()
+            if progress is not None:
+                progress(stage, total-remaining, total)
+
         #While there are holes w/o an assigned cassette (groups don't count)
+        n_skys=len(unassigned_skys)
         while len(unassigned_skys) > 0:
+            step('sky', len(unassigned_skys), n_skys)
             #Update cassette availability for each hole (a cassette may have filled)
             for h in unassigned_skys:
                 #Get cassettes with correct slit and free fibers
@@ -404,8 +656,8 @@ class Plate(object):
                                     if h.isAssignable(cassette=c) and
                                     c.n_avail() >0]
                 if len(possible_cassettes)<1:
-                    print 'Could not find a suitable cassette for {}'.format(h)
-                    import pdb;pdb.set_trace()
+                    raise InfeasibleSetup('Could not find a suitable cassette '
+                                          'for {}'.format(h))
                 #Set the cassetes that are usable for the hole
                 #  no_add is true so we keep the distribution of sky fibers
                 h.assign_possible_cassette(possible_cassettes,
@@ -424,7 +676,9 @@ class Plate(object):
         holes_to_assign=unassigned_objs
 
         #While there are holes w/o an assigned cassette (groups don't count)
+        n_objs=len(holes_to_assign)
         while len(holes_to_assign) > 0:
+            step('object', len(holes_to_assign), n_objs)
             #Update cassette availability for each hole (a cassette may have filled)
             for h in holes_to_assign:
                 #Get cassettes with correct slit and free fibers
@@ -433,8 +687,8 @@ class Plate(object):
                                     if h.isAssignable(cassette=c) and
                                     c.n_avail() >0]
                 if len(possible_cassettes)<1:
-                    print 'Could not find a suitable cassette for {}'.format(h)
-                    import pdb;pdb.set_trace()
+                    raise InfeasibleSetup('Could not find a suitable cassette '
+                                          'for {}'.format(h))
                 #Set the cassetes that are usable for the hole
                 #  no_add is true so we keep the distribution of sky fibers
                 h.assign_possible_cassette(possible_cassettes,
@@ -449,6 +703,7 @@ class Plate(object):
             #Assign to nearest available cassette
             cassettes[h.nearest_usable_cassette()].assign_hole(h)
 
+        step('object', 0, n_objs)
 
         ####All holes have now been assigned to a cassette####
 
@@ -475,16 +730,19 @@ class Plate(object):
                 self.setups[s]['cassetteConfig']=cassettes
             
         
-    def drawHole(self, hole, canvas, color=None, fcolor='White', radmult=1.0, drawimage=0):
-       
+    def drawHole(self, hole, canvas, color=None, fcolor='White', radmult=1.0,
+                 drawimage=0, pos=None):
+        """Draw hole, pos is its shifted position if already known"""
         
-        pos=self.plateCoordShift(hole.position())
+        if pos is None:
+            pos=self.shiftedPositions([hole])[0]
             
         hashtag=".%i"%hole.hash
         if drawimage:
                 canvas.drawCircle( pos, hole.radius*radmult, outline=color, fill=fcolor)
         else:
-            if canvas.find_withtag(hashtag):
+            drawn=self._drawnHoles.setdefault(canvas, {})
+            if hole.hash in drawn:
 #                tmp=list(pos)
 #                tmp.append(hole.hash)
 #                print tmp
@@ -494,11 +752,37 @@ class Plate(object):
 #                #once
 #                print "drawing dupe in Dark Green @ (%f,%f) ID:%i"%tuple(tmp)
                 fcolor='DarkGreen'
-            canvas.drawCircle( pos, hole.radius*radmult, 
+            item=canvas.drawCircle( pos, hole.radius*radmult, key=hashtag,
                                outline=color, fill=fcolor, tags=('hole',hashtag),
                                activefill='Green',activeoutline='Green',
                                disabledfill='Orange',disabledoutline='Orange')
+            drawn.setdefault(hole.hash, []).append(item)
+            self._drawnItems.setdefault(canvas, {})[item]=hole.hash
+
 
+    def drawHoleImages(self, holes, canvas, color=None, fcolor='White',
+                       radmult=1.0, positions=None, width=None):
+        """
+        Draw holes as in drawHole with drawimage set, batching holes of the
+        same radius if the canvas has drawCircles. positions are the holes'
+        shifted positions if already known, width the outline width for
+        batches.
+        """
+        if positions is None:
+            positions=self.shiftedPositions(holes)
+        
+        if not hasattr(canvas, 'drawCircles'):
+            for h, pos in zip(holes, positions):
+                self.drawHole(h, canvas, color=color, fcolor=fcolor,
+                              radmult=radmult, drawimage=True, pos=pos)
+            return
+        
+        byradius={}
+        for h, pos in zip(holes, positions):
+            byradius.setdefault(h.radius, []).append(pos)
+        for radius, points in byradius.iteritems():
+            canvas.drawCircles(points, radius*radmult, outline=color,
+                               fill=fcolor, width=width)
 
     def plateCoordShift(self, (xin, yin), force=False):
         """ Shifts x and y to their new positions in scaled space,
@@ -528,8 +812,78 @@ class Plate(object):
             yp=rp*cpsi
             return (xp/SCALE, yp/SCALE)
 
+    def plateCoordShiftArray(self, xy, force=False):
+        """ Vectorized plateCoordShift. xy is an (N,2) array-like of
+            positions, returns an (N,2) array of shifted positions."""
+        xy=np.asarray(xy, dtype=float).reshape(-1, 2)
+        if not self.doCoordShift and not force:
+            return xy.copy()
+        
+        D=self.coordShift_D
+        a=self.coordShift_a
+        R=self.coordShift_R
+        rm=self.coordShift_rm
+        
+        x=xy[:,0]*SCALE
+        y=xy[:,1]*SCALE
+        r=np.hypot(x, y)
+        center=(r==0.0)
+        #avoid dividing by zero, the center is unshifted
+        rsafe=np.where(center, 1.0, r)
+        cpsi=y/rsafe
+        spsi=x/rsafe
+        d=np.sqrt(R**2 - r**2) - math.sqrt(R**2 - rm**2)
+        dr=d*r/(D+d)
+        
+        rp=(r-dr)*(1.0+a*cpsi)
+        out=np.column_stack((rp*spsi, rp*cpsi))/SCALE
+        out[center]=xy[center]
+        return out
+
+    def coordShiftKey(self):
+        """Tuple of the parameters the coordinate shift depends on"""
+        return (self.doCoordShift, self.coordShift_D, self.coordShift_R,
+                self.coordShift_rm, self.coordShift_a)
+
+    def _shiftedPositionDict(self):
+        """
+        Return a dict of the shifted position of every hole by hole hash for
+        the current coordinate shift parameters. The most recently used
+        SHIFT_CACHE_SIZE parameter sets are cached, so changing a parameter
+        or toggling the shift selects a different cache entry.
+        """
+        with self._shiftLock:
+            key=self.coordShiftKey()
+            if key in self._shiftCache:
+                shifted=self._shiftCache.pop(key)
+            else:
+                holes=list(self.holeSet)
+                positions=self.plateCoordShiftArray([h.position() for h in holes])
+                shifted={h.hash:tuple(p)
+                         for h, p in zip(holes, positions.tolist())}
+                if len(self._shiftCache) >= SHIFT_CACHE_SIZE:
+                    self._shiftCache.popitem(last=False)
+            self._shiftCache[key]=shifted
+        return shifted
+
+    def shiftedPositions(self, holes):
+        """Return a list of the shifted (x,y) positions of holes"""
+        shifted=self._shiftedPositionDict()
+        try:
+            return [shifted[h.hash] for h in holes]
+        except KeyError:
+            #Not all the holes are on the plate
+            positions=self.plateCoordShiftArray([h.position() for h in holes])
+            return [tuple(p) for p in positions.tolist()]
+
     def draw(self, canvas, active_setup=None, channel='all'):
         
+        self._drawnHoles[canvas]={}
+        self._drawnItems[canvas]={}
+        self._backgroundHoles[canvas]=set()
+        for item in self._overlays.pop(canvas, {}).itervalues():
+            canvas.delete(item)
+        
         #Make a circle of appropriate size in the window
         canvas.drawCircle( (0,0) , Plate.RADIUS)
         
@@ -540,12 +894,19 @@ class Plate(object):
             inactiveHoles=self.holeSet.difference(setup['unused_holes'])
             inactiveHoles.difference_update(setup['holes'])
             
-            inactiveHoles.add(self.plateHoleInfo.standard['hole'])
-            inactiveHoles.add(self.plateHoleInfo.sh_hole)
+            #The standard and Shack-Hartman holes are always drawn, those the
+            # setup uses too are marked as drawn twice when the setup's holes
+            # are drawn, rather than also drawn as inactive
+            used=set(setup['holes']).union(setup['unused_holes'])
+            for h in (self.plateHoleInfo.standard['hole'],
+                      self.plateHoleInfo.sh_hole):
+                if h in used:
+                    self._drawnHoles[canvas][h.hash]=[]
+                else:
+                    inactiveHoles.add(h)
             
             #Draw the holes that aren't in the current setup
-            for h in inactiveHoles:
-                self.drawHole(h, canvas)
+            self.drawInactiveHoles(inactiveHoles, canvas)
             
             #If holes in setup have been grouped then draw the groups
             # otherwise draw them according to their channel
@@ -555,11 +916,44 @@ class Plate(object):
                 self._draw_without_assignements(setup, channel, canvas)
             
             #Draw the guide and acquisition holes in color
-            for h in setup['unused_holes']:
-                self.drawHole(h, canvas, color='Green')
+            unused=setup['unused_holes']
+            for h, pos in zip(unused, self.shiftedPositions(unused)):
+                self.drawHole(h, canvas, color='Green', pos=pos)
         else:
-            for h in self.holeSet:
-                self.drawHole(h, canvas)
+            self.drawInactiveHoles(self.holeSet, canvas)
+
+    def drawInactiveHoles(self, holes, canvas):
+        """
+        Draw the holes outside the active setup. If the canvas can show a
+        background image the holes are rendered into one, cached for the
+        holes, the coordinate shift, and the canvas size, and get items only
+        when needed, see getDrawnItems. Otherwise each is drawn with drawHole.
+        """
+        if not hasattr(canvas, 'drawBackground'):
+            holes=list(holes)
+            for h, pos in zip(holes, self.shiftedPositions(holes)):
+                self.drawHole(h, canvas, pos=pos)
+            return
+        
+        width=int(round(2*canvas.centerx))
+        height=int(round(2*canvas.centery))
+        key=(frozenset(h.hash for h in holes), self.coordShiftKey(),
+             width, height, canvas.scalex, canvas.scaley, canvas.bg)
+        if key in self._backgroundCache:
+            image=self._backgroundCache.pop(key)
+        else:
+            imgcanvas=ImageCanvas.ImageCanvas(width, height,
+                                              canvas.centerx/canvas.scalex,
+                                              canvas.centery/canvas.scaley,
+                                              bg=canvas.bg)
+            self.drawHoleImages(list(holes), imgcanvas, color='Black',
+                                width=1)
+            image=imgcanvas.render()
+            if len(self._backgroundCache) >= BACKGROUND_CACHE_SIZE:
+                self._backgroundCache.popitem(last=False)
+        self._backgroundCache[key]=image
+        canvas.drawBackground(image)
+        self._backgroundHoles[canvas]=set(h.hash for h in holes)
 
     def _draw_with_assignements(self, setup, channel, canvas, radmult=1.0,
                                 lblcolor='black', drawimage=False):
@@ -577,31 +971,31 @@ class Plate(object):
         #List of cassette labels and first hole positions
         labeldata=[]
         
+        #The cassettes to draw and their shifted hole positions
+        cassettes=[c for c in setup['cassetteConfig'].itervalues()
+                   if c.used and ((drawred and c.color()=='red') or
+                                  (drawblue and c.color()=='blue'))]
+        positions=[self.shiftedPositions(c.ordered_holes()) for c in cassettes]
+        
+        #Draw the first & last hole markers of all the cassettes at once
+        markers=[]
+        for pos in positions:
+            markers.extend(self.cassetteMarkers(pos, radmult=radmult))
+        self.drawMarkers(markers, canvas)
+        
         #Draw all the cassettes
-        for cassette in setup['cassetteConfig'].itervalues():
-            #canvas.drawCircle(cassette.pos, .02, outline='pink', fill='pink')
-            if cassette.used==0:
-                continue
-            if drawred and cassette.color()=='red':
-                #Draw the cassette
-                self.drawCassette(cassette, canvas, radmult=radmult,
-                                  drawimage=drawimage)
-                #Grab the first hole position
-                start_pos=cassette.first_hole().position()
-                #Grab the label text
-                label=cassette.label()
-                #Add the label, color, and start pos to the pot
-                labeldata.append(('red', start_pos, label, cassette.onRight()))
-            if drawblue and cassette.color()=='blue':
-                #Draw the cassette
-                self.drawCassette(cassette, canvas, radmult=radmult,
-                                  drawimage=drawimage)
-                #Grab the first hole position
-                start_pos=cassette.first_hole().position()
-                #Grab the label text
-                label=cassette.label()
-                #Add the label, color, and start pos to the pot
-                labeldata.append(('blue', start_pos, label, cassette.onRight()))
+        for cassette, pos in zip(cassettes, positions):
+            #Draw the cassette
+            self.drawCassette(cassette, canvas, radmult=radmult,
+                              drawimage=drawimage, positions=pos,
+                              markers=False)
+            #Grab the first hole position
+            start_pos=cassette.first_hole().position()
+            #Grab the label text
+            label=cassette.label()
+            #Add the label, color, and start pos to the pot
+            labeldata.append((cassette.color(), start_pos, label,
+                              cassette.onRight()))
         
         labeldata.sort(key=lambda x:x[1][1])
         
@@ -627,12 +1021,12 @@ class Plate(object):
         #Kludge for image cavas
         if isinstance(canvas, ImageCanvas.ImageCanvas):
             for i in range(len(labeldata)):
-                label=labeldata[2]
-                side=labeldata
+                label=labeldata[i][2]
+                side=labeldata[i][3]
                 if not side: #on right
-                    labelpos[i][0]-=canvas.getTextSize(label)
+                    labelpos[i][0]-=canvas.getTextSize(label)[0]
                 else:
-                    labelpos[i][0]-=2*canvas.getTextSize(label)
+                    labelpos[i][0]-=2*canvas.getTextSize(label)[0]
         
         #Draw the labels
         for i in xrange(len(labeldata)):
@@ -661,35 +1055,49 @@ class Plate(object):
             redcolor='red'
             nonecolor=None
 
-        for h in setup['holes']:
+        holes=setup['holes']
+        
+        if drawimage:
+            #Draw each color in a batch
+            colors={'blue':bluecolor, 'red':redcolor}
+            bycolor={}
+            for h in holes:
+                bycolor.setdefault(colors.get(h.assigned_color(), nonecolor),
+                                   []).append(h)
+            for color, chole in bycolor.iteritems():
+                self.drawHoleImages(chole, canvas, color=color, fcolor=color,
+                                    radmult=radmult)
+            return
+        
+        for h, pos in zip(holes, self.shiftedPositions(holes)):
             hcolor=h.assigned_color()
             if hcolor == 'blue':
                 if drawimage:
                     self.drawHole(h, canvas, color=bluecolor,
                                   drawimage=drawimage,
                                   fcolor=bluecolor,
-                                  radmult=radmult)
+                                  radmult=radmult, pos=pos)
                 else:
                     self.drawHole(h, canvas, color=bluecolor,
-                                  radmult=radmult)
+                                  radmult=radmult, pos=pos)
             elif hcolor =='red':
                 if drawimage:
                     self.drawHole(h, canvas, color=redcolor,
                                   drawimage=drawimage,
                                   fcolor=redcolor,
-                                  radmult=radmult)
+                                  radmult=radmult, pos=pos)
                 else:
                     self.drawHole(h, canvas, color=redcolor,
-                                  radmult=radmult)
+                                  radmult=radmult, pos=pos)
             else:
                 if drawimage:
                     self.drawHole(h, canvas, color=nonecolor,
                                   drawimage=drawimage,
                                   fcolor=nonecolor,
-                                  radmult=radmult)
+                                  radmult=radmult, pos=pos)
                 else:
                     self.drawHole(h, canvas, color=nonecolor,
-                                  radmult=radmult)
+                                  radmult=radmult, pos=pos)
 
     def drawImage(self, canvas, active_setup=None, channel='all',radmult=.75):
         if active_setup and active_setup in self.setups:
@@ -710,9 +1118,8 @@ class Plate(object):
                 self._draw_without_assignements(setup, channel, canvas,
                                                 drawimage=True, radmult=radmult)
 
-            for h in setup['unused_holes']:
-                self.drawHole(h, canvas,color='Yellow',fcolor='Yellow',
-                              radmult=radmult,drawimage=True)
+            self.drawHoleImages(setup['unused_holes'], canvas, color='Yellow',
+                                fcolor='Yellow', radmult=radmult)
 
             #draw standard and shack hartman
             self.drawHole(self.plateHoleInfo.standard['hole'], canvas,
@@ -737,117 +1144,143 @@ class Plate(object):
             else:
                 raise Exception('Channel has invalid value:'+channel)
 
-            for h in inactiveHoles:
-                pos=self.plateCoordShift(h.position())    
+            for h, pos in zip(inactiveHoles, self.shiftedPositions(inactiveHoles)):
                 canvas.drawSquare(pos,h.radius/3,fill='White',outline='White')
     
-    def drawCassette(self, cassette, canvas, radmult=1.0, drawimage=False):
+    def cassetteMarkers(self, positions, radmult=1.0):
+        """
+        Return the line segments of the x across the first and the + over the
+        last of a cassette's ordered hole positions
+        """
+        #An x across the first hole
+        x,y=positions[0]
+        radius=2*0.08675*radmult/SCALE
+        segments=[((x-radius,y+radius),(x+radius,y-radius)),
+                  ((x-radius,y-radius),(x+radius,y+radius))]
+        
+        #A + over the last hole
+        x,y=positions[-1]
+        radius=1.41*2*0.08675*radmult/SCALE
+        segments.extend([((x-radius,y),(x+radius,y)),
+                         ((x,y-radius),(x,y+radius))])
+        return segments
+
+    def drawMarkers(self, segments, canvas):
+        """Draw cassette marker segments, in one call if the canvas can"""
+        pluscrosscolor='Lime'
+        if hasattr(canvas, 'drawLines'):
+            canvas.drawLines(segments, fill=pluscrosscolor)
+        else:
+            for pos0, pos1 in segments:
+                canvas.drawLine(pos0, pos1, fill=pluscrosscolor)
+
+    def drawCassette(self, cassette, canvas, radmult=1.0, drawimage=False,
+                     positions=None, markers=True):
+        """
+        Draw the holes of cassette and the path between them, with the first
+        and last hole markers if markers. positions are the holes' shifted
+        positions if already known.
+        """
         color=cassette.color()
         
         if cassette.used==0:
             return
         
-        pluscrosscolor='Lime'
-        #Draw an x across the first hole
-        x,y=self.plateCoordShift(cassette.first_hole().position())
-        radius=2*0.08675*radmult/SCALE
-        canvas.drawLine((x-radius,y+radius),(x+radius,y-radius),
-                        fill=pluscrosscolor)
-        canvas.drawLine((x-radius,y-radius),(x+radius,y+radius),
-                        fill=pluscrosscolor)
+        holes=cassette.ordered_holes()
         
-        #Draw a + over the last hole
-        x,y=self.plateCoordShift(cassette.last_hole().position())
-        radius=1.41*2*0.08675*radmult/SCALE
-        canvas.drawLine((x-radius,y),(x+radius,y), fill=pluscrosscolor)
-        canvas.drawLine((x,y-radius),(x,y+radius), fill=pluscrosscolor)
+        #Shift all the hole positions at once
+        if positions is None:
+            positions=self.shiftedPositions(holes)
+        
+        if markers:
+            self.drawMarkers(self.cassetteMarkers(positions, radmult=radmult),
+                             canvas)
         
-        holes=cassette.ordered_holes()
-
         #Draw the holes in the cassette
-        for h in holes:
-            self.drawHole(h, canvas, color=color, fcolor=color,
-                          radmult=radmult,drawimage=drawimage)
+        if drawimage:
+            self.drawHoleImages(holes, canvas, color=color, fcolor=color,
+                                radmult=radmult, positions=positions)
+        else:
+            for h, pos in zip(holes, positions):
+                self.drawHole(h, canvas, color=color, fcolor=color,
+                              radmult=radmult, pos=pos)
 
         if cassette.used==1:
             return
 
-        #Draw the paths between each of the holes
-        for i in range(len(holes)-1):
-            p0=holes[i].position()
-            p1=holes[i+1].position()
-            canvas.drawLine(self.plateCoordShift(p0), self.plateCoordShift(p1),
-                            fill=color)
-        
-    def setCoordShiftD(self, D):
-        if self.isValidCoordParam_D(D):
-            self.coordShift_D=float(D)
+        #Draw the path between the holes
+        if hasattr(canvas, 'drawPolyline'):
+            canvas.drawPolyline(positions, fill=color)
         else:
+            for i in range(len(holes)-1):
+                canvas.drawLine(positions[i], positions[i+1], fill=color)
+        
+    def setCoordShift(self, D=None, R=None, rm=None, a=None):
+        """
+        Set the coordinate shift parameters given, as numbers or strings,
+        keeping the current values of the others. The new set is validated
+        as a whole and applied in one step, ValueError is raised if it is not
+        valid.
+        """
+        params=self._coordShiftParams(D, R, rm, a)
+        if params is None:
             raise ValueError()
+        with self._shiftLock:
+            (self.coordShift_D, self.coordShift_R, self.coordShift_rm,
+             self.coordShift_a)=params
+
+    def setCoordShiftD(self, D):
+        self.setCoordShift(D=D)
     
     def setCoordShiftR(self, R):
-        if self.isValidCoordParam_D(R):
-            self.coordShift_R=float(R)
-        else:
-            raise ValueError()
+        self.setCoordShift(R=R)
     
     def setCoordShiftrm(self, rm):
-        if self.isValidCoordParam_rm(rm):
-            self.coordShift_rm=float(rm)
-        else:
-            raise ValueError()
+        self.setCoordShift(rm=rm)
     
     def setCoordShifta(self, a):
-        if self.isValidCoordParam_D(a):
-            self.coordShift_a=float(a)
-        else:
-            raise ValueError()
+        self.setCoordShift(a=a)
+    
+    def isValidCoordShift(self, D=None, R=None, rm=None, a=None):
+        """
+        True if the coordinate shift parameters given, with the current values
+        of the others, are a valid set
+        """
+        return self._coordShiftParams(D, R, rm, a) is not None
+    
+    def _coordShiftParams(self, D, R, rm, a):
+        """
+        Return the float (D, R, rm, a) of the parameters given, with the
+        current values of the others, or None if they are not a valid set
+        """
+        params=[]
+        for x, current in ((D, self.coordShift_D), (R, self.coordShift_R),
+                           (rm, self.coordShift_rm), (a, self.coordShift_a)):
+            if x is None:
+                params.append(current)
+            elif type(x) in [int,long,float,str]:
+                try:
+                    params.append(float(x))
+                except ValueError:
+                    return None
+            else:
+                return None
+        D, R, rm, a=params
+        if D > 0.0 and R > 0.0 and rm > 0.0 and R**2-rm**2 >= 0.0:
+            return tuple(params)
+        return None
     
     def isValidCoordParam_D(self, x):
-        if type(x) in [int,long,float]:
-            return float(x) > 0.0
-        elif type(x) is str:
-            try: 
-                float(x)
-                return float(x) > 0.0
-            except ValueError:
-                return False
-        else:
-            return False
+        return x is not None and self.isValidCoordShift(D=x)
         
     def isValidCoordParam_R(self, x):
-        if type(x) in [int,long,float]:
-            return float(x)**2-self.coordShift_rm**2 >= 0.0 and float(x) > 0.0
-        elif type(x) is str:
-            try: 
-                return float(x)**2-self.coordShift_rm**2 >= 0.0 and float(x) > 0.0
-            except ValueError:
-                return False
-        else:
-            return False
+        return x is not None and self.isValidCoordShift(R=x)
         
     def isValidCoordParam_rm(self, x):
-        if type(x) in [int,long,float]:
-            return self.coordShift_R**2-float(x)**2 >= 0.0 and float(x) > 0.0
-        elif type(x) is str:
-            try: 
-                return self.coordShift_R**2-float(x)**2 >= 0.0 and float(x) > 0.0
-            except ValueError:
-                return False
-        else:
-            return False
+        return x is not None and self.isValidCoordShift(rm=x)
         
     def isValidCoordParam_a(self, x):
-        if type(x) in [int,long,float]:
-            return True
-        elif type(x) is str:
-            try: 
-                float(x)
-                return True
-            except ValueError:
-                return False
-        else:
-            return False
+        return x is not None and self.isValidCoordShift(a=x)
 
     def isValidSetup(self,s):
         ret=True
@@ -0,0 +1,209 @@
+'''
+Vector canvas for plate maps
+
+SVGCanvas takes the same drawing calls as BetterCanvas and ImageCanvas, so
+Plate.draw and Plate.drawImage work with it unchanged, and writes the drawing
+as SVG or, if cairosvg is installed, PDF. Elements are written to the output
+as they are drawn, so large plates aren't held in memory.
+'''
+import math
+import os
+import tempfile
+import PIL.ImageColor as imgColor
+from xml.sax.saxutils import escape, quoteattr
+
+#Font size of text in pixels and the approximate width of a character
+FONT_SIZE=12
+CHAR_WIDTH=0.6*FONT_SIZE
+
+class SVGCanvas(object):
+    """
+    A canvas writing drawing as SVG elements to file, a file name or a file
+    object. A file name ending in .pdf is written as PDF, converted from an
+    SVG in a temporary file by close(). The drawing is complete once close()
+    is called, or the with block using the canvas ends.
+
+    bg is the background color, default_color the outline color of shapes
+    drawn without one. Use bg='Black', default_color='White' for drawings
+    matching the projector images of ImageCanvas. Tk specific keywords
+    passed to the drawing calls are ignored.
+    """
+    def __init__(self, file, width, height, units_hwidth, units_hheight,
+                 bg='White', default_color='Black', line_width=1):
+        self.width=width
+        self.height=height
+        self.bg=bg
+        self.default_color=default_color
+        self.line_width=line_width
+
+        self.centerx=float(width)/2.0
+        self.centery=float(height)/2.0
+
+        self.scalex=self.centerx/units_hwidth
+        self.scaley=self.centery/units_hheight
+
+        self.pdffile=None
+        self.own_fp=isinstance(file, basestring)
+        if not self.own_fp:
+            self.fp=file
+        elif file.lower().endswith('.pdf'):
+            try:
+                import cairosvg
+            except ImportError:
+                raise ImportError('cairosvg is required to save PDFs')
+            self.pdffile=file
+            fd, self.svgfile=tempfile.mkstemp(suffix='.svg')
+            self.fp=os.fdopen(fd, 'w')
+        else:
+            self.fp=open(file, 'w')
+        self.n_elements=0
+
+        self.fp.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.fp.write('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+                      'width="{0}" height="{1}" viewBox="0 0 {0} {1}">\n'.format(
+                      width, height))
+        if bg:
+            self._add('<rect width="100%" height="100%" fill={}/>'.format(
+                      quoteattr(_color(bg))))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Finish the SVG document, closing the file and making the PDF"""
+        if self.fp is None:
+            return
+        self.fp.write('</svg>\n')
+        if self.own_fp:
+            self.fp.close()
+        self.fp=None
+        if self.pdffile:
+            import cairosvg
+            try:
+                cairosvg.svg2pdf(url=self.svgfile, write_to=self.pdffile)
+            finally:
+                os.remove(self.svgfile)
+
+    def _add(self, element):
+        self.fp.write(element)
+        self.fp.write('\n')
+        self.n_elements+=1
+        return self.n_elements
+
+    def _style(self, outline, fill, width=None):
+        return 'stroke={} fill={} stroke-width="{:g}"'.format(
+                quoteattr(_color(outline or self.default_color)),
+                quoteattr(_color(fill) if fill else 'none'),
+                width or self.line_width)
+
+    def drawCircle(self, (x,y), r, fill=None, outline=None, width=None, **kw):
+        return self._add('<circle cx="{:.2f}" cy="{:.2f}" r="{:.2f}" {}/>'.format(
+                         self.canvasCoordx(x), self.canvasCoordy(y),
+                         abs(r*self.scalex), self._style(outline, fill, width)))
+
+    def drawCircles(self, points, r, fill=None, outline=None, width=None):
+        """Draw circles of radius r centered on each of points"""
+        style=self._style(outline, fill, width)
+        rad=abs(r*self.scalex)
+        for x,y in points:
+            self._add('<circle cx="{:.2f}" cy="{:.2f}" r="{:.2f}" {}/>'.format(
+                      self.canvasCoordx(x), self.canvasCoordy(y), rad, style))
+
+    #x,y are at center len is length of side
+    def drawSquare(self, (x,y), len, outline=None, fill=None, width=None,
+                   **kw):
+        return self.drawRectangle((x-len/2., y-len/2., x+len/2., y+len/2.),
+                                  outline=outline, fill=fill, width=width)
+
+    # x0,y0 is one corner, x1,y1 is corner diagonally across
+    def drawRectangle(self, (x0,y0,x1,y1), outline=None, fill=None, width=None,
+                      **kw):
+        x0c,x1c=sorted((self.canvasCoordx(x0), self.canvasCoordx(x1)))
+        y0c,y1c=sorted((self.canvasCoordy(y0), self.canvasCoordy(y1)))
+        return self._add('<rect x="{:.2f}" y="{:.2f}" width="{:.2f}" '
+                         'height="{:.2f}" {}/>'.format(x0c, y0c, x1c-x0c,
+                         y1c-y0c, self._style(outline, fill, width)))
+
+    ##takes either (x0,y0), (x1,y1)  or (x,y), r,theta
+    def drawLine(self, *args, **kw):
+        assert len(args) == 2 or len(args) == 3
+
+        pos0 = args[0]
+        if len(args) == 2:
+            pos1 = args[1]
+        else:
+            l = args[1]
+            th = args[2]
+            x2=pos0[0]+l*math.cos(math.radians(th))
+            y2=pos0[1]+l*math.sin(math.radians(th))
+            pos1=(x2,y2)
+
+        style=self._style(kw.get('fill'), None, kw.get('width'))
+        if kw.get('dashing'):
+            style+=' stroke-dasharray="5,5"'
+
+        return self._add('<line x1="{:.2f}" y1="{:.2f}" x2="{:.2f}" '
+                         'y2="{:.2f}" {}/>'.format(
+                         self.canvasCoordx(pos0[0]), self.canvasCoordy(pos0[1]),
+                         self.canvasCoordx(pos1[0]), self.canvasCoordy(pos1[1]),
+                         style))
+
+    def drawLines(self, segments, fill=None, **kw):
+        """Draw the line segments ((x0,y0), (x1,y1)) of segments as one path"""
+        if not len(segments):
+            return
+        d=' '.join('M{:.2f},{:.2f} L{:.2f},{:.2f}'.format(
+                   self.canvasCoordx(x0), self.canvasCoordy(y0),
+                   self.canvasCoordx(x1), self.canvasCoordy(y1))
+                   for (x0,y0), (x1,y1) in segments)
+        return self._add('<path d="{}" {}/>'.format(d,
+                         self._style(fill, None, kw.get('width'))))
+
+    def drawPolyline(self, points, fill=None, **kw):
+        """Draw connected line segments through each of points"""
+        if len(points) < 2:
+            return
+        xy=' '.join('{:.2f},{:.2f}'.format(self.canvasCoordx(x),
+                                           self.canvasCoordy(y))
+                    for x,y in points)
+        return self._add('<polyline points="{}" {}/>'.format(xy,
+                         self._style(fill, None, kw.get('width'))))
+
+    # x,y is at upper left corner of text unless center is set to 1
+    def drawText(self, (x,y), text, color=None, center=0, **kw):
+        if center:
+            anchor='text-anchor="middle" dominant-baseline="central"'
+        else:
+            anchor='dominant-baseline="hanging"'
+        return self._add('<text x="{:.2f}" y="{:.2f}" font-family="Arial" '
+                         'font-size="{}" fill={} {}>{}</text>'.format(
+                         self.canvasCoordx(x), self.canvasCoordy(y), FONT_SIZE,
+                         quoteattr(_color(color or self.default_color)),
+                         anchor, escape(text)))
+
+    def getTextSize(self, text):
+        """Approximate size of text in input units"""
+        wid,ht=CHAR_WIDTH*len(text), FONT_SIZE
+        return ( self.inputCoordx(wid)-self.inputCoordx(0),
+                 self.inputCoordy(ht)-self.inputCoordy(0) )
+
+    # go from coordinates with 0,0 at center to 0,0 at upper left
+    def canvasCoordx(self, x):
+        return -self.scalex*x+self.centerx
+
+    def canvasCoordy(self, y):
+        return -self.scaley*y + self.centery
+
+    def inputCoordx(self, x):
+        return (self.centerx-x)/self.scalex
+
+    def inputCoordy(self, y):
+        return (self.centery-y)/self.scaley
+
+
+def _color(name):
+    """SVG color for a Tk/PIL color name"""
+    return "#%02x%02x%02x" % imgColor.getrgb(name)[:3]
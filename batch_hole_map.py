@@ -1,10 +1,280 @@
-import Plate
+#! /usr/bin/env python
+'''
+Run the hole mapping steps of hole_map_gui.py on many plates
+
+Each plate file is put through the stages in order:
+    load       read the _Sum.asc file, with its .res file, or the .plate file
+    regionify  assign fibers to every setup, the setups of an assign with
+               group are assigned together
+    write      write the .plate file, a .plate file being run is only
+               replaced if asked to
+    images     render the projector images, as export_images.py does
+Plates are processed in a pool of worker processes and the time taken by each
+stage is printed. Exits with status 2 if a setup couldn't be assigned and 1 if
+anything else failed.
+'''
+import argparse
 import glob
-if __name__==__main__:
-    files=glob.glob('*.asc')
-    p=Plate.Plate()
-    for f in files:
-        p.load(f)
-        for s in p.setups.keys():
-            p.regionify(setup_number=s.split()[1])
-        p.write_platefile()
\ No newline at end of file
+import itertools
+import multiprocessing
+import os.path
+import sys
+import time
+from collections import OrderedDict
+import Plate
+import export_images
+
+STAGES=['load', 'regionify', 'write', 'images']
+#Comma separated patterns of the plate files to use in directories
+PATTERNS='*_Sum.asc,*.plate'
+
+def setup_groups(plate, groups):
+    """
+    Return the lists of setup numbers of plate to assign fibers to together,
+    the assign with groups followed by each setup not in a group in numeric
+    order. Raises ValueError if a setup is in more than one group.
+    """
+    grouped=[]
+    for group in groups:
+        if not plate.isValidAssignwith(group):
+            raise ValueError('Setups {} not all on plate'.format(','.join(group)))
+        for n in group:
+            if n in grouped:
+                raise ValueError('Setup {} is in more than one assign with '
+                                 'group'.format(n))
+            grouped.append(n)
+    numbers=sorted((s.split()[1] for s in plate.setups), key=int)
+    return list(groups)+[[n] for n in numbers if n not in grouped]
+
+#The stages are called with the plate and the run_plate arguments as a dict
+# and return the list of files they wrote
+
+def _load(plate, job):
+    file=job['source'] or job['file']
+    if not os.path.isfile(file):
+        raise IOError('No such file')
+    plate.load(file)
+
+def _regionify(plate, job):
+    for group in setup_groups(plate, job['groups']):
+        plate.regionify(setup_number=group[0], awith=group[1:])
+
+def _write(plate, job):
+    outfile=plate_file(job['file'], job['outdir'])
+    if (os.path.abspath(outfile)==os.path.abspath(job['file']) and
+        not job['in_place']):
+        raise IOError('Would replace {}, give an output directory or write '
+                      'in place'.format(os.path.basename(outfile)))
+    plate.plateHoleInfo.write_platefile(outfile)
+    return [outfile]
+
+def _images(plate, job):
+    outfiles=[]
+    outdir=job['outdir'] or os.path.dirname(job['file'])
+    for setup, channel, outfile in export_images.image_jobs(plate, job['file'],
+                                                            outdir):
+        export_images.draw_image(plate, setup, channel, outfile,
+                                 job['image_options'])
+        outfiles.append(outfile)
+    return outfiles
+
+_stage_funcs={'load':_load, 'regionify':_regionify, 'write':_write,
+              'images':_images}
+
+def plate_file(file, outdir=None):
+    """
+    Return the name of the .plate file written for a plate file, next to the
+    _Sum.asc file, or the .plate file itself, unless outdir is given
+    """
+    if 'Sum.asc' in file:
+        outfile=file.replace('_Sum.asc', '.plate')
+    else:
+        outfile=file
+    if outdir:
+        outfile=os.path.join(outdir, os.path.basename(outfile))
+    return outfile
+
+def run_plate(file, stages=STAGES, groups=(), outdir=None, image_options={},
+              source=None, in_place=False):
+    """
+    Run stages on a plate file, load is always run. groups are the lists of
+    setup numbers to assign together. The .plate file and images are written
+    to outdir, by default the .plate file goes next to the _Sum.asc file and
+    the images go next to the plate file. The write stage fails rather than
+    replace a .plate file being run unless in_place is set.
+    source is loaded in place of file if given, the .plate file written by
+    an earlier run, say, while outputs are still named after file.
+
+    Returns a dict of the 'file', the seconds taken by each stage run as
+    'times', the files written by each stage as 'outputs', the 'error'
+    message if a stage failed and whether it failed because a setup was
+    'infeasible'. Stages after a failed stage aren't run.
+    """
+    result={'file':file, 'times':OrderedDict(), 'outputs':{},
+            'error':None, 'infeasible':False}
+    job={'file':file, 'groups':groups, 'outdir':outdir,
+         'image_options':image_options, 'source':source, 'in_place':in_place}
+    plate=Plate.Plate()
+    for stage in STAGES:
+        if stage != 'load' and stage not in stages:
+            continue
+        start=time.time()
+        try:
+            outputs=_stage_funcs[stage](plate, job)
+        except Plate.InfeasibleSetup, e:
+            result['error']='Infeasible Setup: {}'.format(e)
+            result['infeasible']=True
+        except Exception, e:
+            result['error']='{} Error: {}'.format(stage.capitalize(), e)
+        if result['error']:
+            break
+        result['times'][stage]=time.time()-start
+        result['outputs'][stage]=outputs or []
+    return result
+
+def _run_plate(args):
+    return run_plate(*args)
+
+def batch_hole_map(platefiles, stages=STAGES, groups=(), outdir=None,
+                   workers=1, compress_level=6, in_place=False):
+    """
+    Run stages on platefiles using workers processes, printing the time taken
+    by each stage. Returns the list of run_plate results.
+    """
+    image_options={'compress_level':compress_level}
+    tasks=[(file, stages, groups, outdir, image_options, None, in_place)
+           for file in platefiles]
+
+    if workers > 1:
+        pool=multiprocessing.Pool(workers)
+        results=pool.imap_unordered(_run_plate, tasks)
+    else:
+        pool=None
+        results=itertools.imap(_run_plate, tasks)
+
+    start=time.time()
+    totals=OrderedDict((stage, 0.0) for stage in STAGES)
+    done=[]
+    try:
+        for result in results:
+            done.append(result)
+            print_result(result)
+            for stage, seconds in result['times'].iteritems():
+                totals[stage]+=seconds
+    finally:
+        if pool:
+            pool.terminate()
+
+    failed=len([r for r in done if r['error']])
+    print 'Processed {} plates, {} failed, in {:.2f}s'.format(len(done),
+                                                  failed, time.time()-start)
+    print 'Stage totals:', ' '.join('{} {:.2f}s'.format(stage, seconds)
+                                    for stage, seconds in totals.iteritems()
+                                    if stage == 'load' or stage in stages)
+    return done
+
+def print_result(result):
+    """Print the time taken by each stage run on a plate and any error"""
+    times=' '.join('{} {:.2f}s'.format(stage, seconds)
+                   for stage, seconds in result['times'].iteritems())
+    print result['file'], times, result['error'] or ''
+
+def exit_status(results):
+    """2 if a setup was infeasible, 1 if anything else failed, otherwise 0"""
+    if [r for r in results if r['infeasible']]:
+        return 2
+    if [r for r in results if r['error']]:
+        return 1
+    return 0
+
+def find_platefiles(names, patterns=PATTERNS):
+    """
+    Return the plate files named by names, which may be files, globs or
+    directories. The files of a directory matching any of the comma separated
+    patterns are used, except .plate files written from a _Sum.asc file also
+    used, as running the _Sum.asc file writes them again.
+    """
+    patterns=[p for p in patterns.replace(' ','').split(',') if p]
+    files=[]
+    for name in names:
+        if os.path.isdir(name):
+            found=set()
+            for pattern in patterns:
+                found.update(glob.glob(os.path.join(name, pattern)))
+            written=set(plate_file(f) for f in found if 'Sum.asc' in f)
+            found=sorted(found-written)
+        else:
+            #Keep names matching nothing so they are reported as missing
+            found=sorted(glob.glob(name)) or [name]
+        files.extend(f for f in found if f not in files)
+    return files
+
+def add_arguments(parser):
+    """Add the arguments selecting plates and configuring the stages"""
+    parser.add_argument('files', nargs='*',
+                        help='Plate files, globs or directories of plates, '
+                        'the current directory by default')
+    parser.add_argument('-p', '--pattern', default=PATTERNS,
+                        help='Comma separated patterns of the files to use in '
+                        'directories, default %(default)s')
+    parser.add_argument('-s', '--stages', default=','.join(STAGES),
+                        help='Comma separated stages to run, default '
+                        '%(default)s')
+    parser.add_argument('-a', '--assign-with', action='append', default=[],
+                        metavar='SETUPS',
+                        help='Comma separated setup numbers to assign fibers '
+                        'to together, may be given more than once')
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='Directory for the .plate files and images')
+    parser.add_argument('--in-place', action='store_true',
+                        help='Replace .plate files being run with the ones '
+                        'written, without it they are only written to an '
+                        'output directory')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Number of worker processes')
+    parser.add_argument('-z', '--compress-level', type=int, default=6,
+                        choices=range(10),
+                        help='PNG compression level, 0 is fastest')
+
+def parse_arguments(parser):
+    """
+    Parse the arguments added by add_arguments, returning the arguments, the
+    plate files, stages and assign with groups. Creates the output directory.
+    """
+    args=parser.parse_args()
+
+    stages=[s for s in args.stages.replace(' ','').split(',') if s]
+    for s in stages:
+        if s not in STAGES:
+            parser.error('Unknown stage {}, valid stages are {}'.format(s,
+                         ','.join(STAGES)))
+    groups=[[s for s in g.replace(' ','').split(',') if s]
+            for g in args.assign_with]
+    grouped=[s for g in groups for s in g]
+    for s in set(grouped):
+        if grouped.count(s) > 1:
+            parser.error('Setup {} is in more than one assign with '
+                         'group'.format(s))
+
+    if args.outdir and not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    files=find_platefiles(args.files or ['.'], args.pattern)
+    return args, files, stages, groups
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Load plates, assign fibers, '
+                                   'write .plate files and render images',
+                                   epilog='Exits with status 2 if a setup '
+                                   "couldn't be assigned, 1 on other errors")
+    add_arguments(parser)
+    args, files, stages, groups=parse_arguments(parser)
+
+    results=batch_hole_map(files,
+                           stages=stages, groups=groups, outdir=args.outdir,
+                           workers=args.workers,
+                           compress_level=args.compress_level,
+                           in_place=args.in_place)
+    sys.exit(exit_status(results))
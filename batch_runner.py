@@ -0,0 +1,249 @@
+#! /usr/bin/env python
+'''
+Run the batch_hole_map.py stages on many plates, resuming where it left off
+
+Progress is kept in a JSON checkpoint file recording, for each plate file,
+the hashes of the files its run depends on and the settings it was run with,
+the stages completed and the hashes of the files each stage wrote. On restart, plates whose stages
+are complete with their outputs unchanged are skipped, and plates missing
+only their images have them rendered from the .plate file already written.
+
+Each plate is run in a process of its own, so a plate crashing its process
+doesn't stop the others. Plates that fail are retried one at a time after
+the others are done, except for those with an infeasible setup.
+'''
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import os.path
+import sys
+import time
+import batch_hole_map
+import deadfibers
+import fiberprofile
+
+CHECKPOINT_VERSION=2
+#Seconds between checks on the plate processes
+POLL_SECONDS=0.05
+
+def file_hash(file):
+    """Return the SHA1 hex digest of the contents of file, None if missing"""
+    try:
+        fp=open(file, 'rb')
+    except IOError:
+        return None
+    sha=hashlib.sha1()
+    with fp:
+        for chunk in iter(lambda: fp.read(1<<20), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def input_hashes(file):
+    """
+    Return a dict of the hashes of the files a run of the plate file depends
+    on, the 'plate' file itself, the 'res' file of a _Sum.asc file, and the
+    'dead_fibers' and 'fiber_profiles' files used to assign fibers
+    """
+    hashes={'plate':file_hash(file),
+            'dead_fibers':file_hash(deadfibers.STATE_FILE),
+            'fiber_profiles':file_hash(fiberprofile.PROFILE_FILE)}
+    if 'Sum.asc' in file:
+        hashes['res']=file_hash(file.replace('Sum.asc', 'plate.res'))
+    return hashes
+
+class Checkpoint(object):
+    """
+    The records of the plates run, by plate file. Each record has the 'input'
+    file hashes from input_hashes, the 'settings' it was run with, the 'stages' completed, each a
+    dict of output hashes by output file, the 'status' of the last run, one
+    of 'done', 'failed' or 'infeasible', its 'error' and the number of
+    'attempts' since the plate last succeeded.
+    """
+    def __init__(self, file):
+        self.file=file
+        self.plates={}
+        if os.path.isfile(file):
+            with open(file) as fp:
+                data=json.load(fp)
+            if data.get('version') == CHECKPOINT_VERSION:
+                self.plates=data['plates']
+
+    def save(self):
+        """Write the checkpoint, only replacing the old one once written"""
+        tmp=self.file+'.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'version':CHECKPOINT_VERSION, 'plates':self.plates},
+                      fp, indent=1, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(self.file):
+            os.remove(self.file)
+        os.rename(tmp, self.file)
+
+    def plan(self, file, settings, inputs):
+        """
+        Return the stages still to run on file with settings and input hashes
+        inputs, and the file to load for them, None for file itself. No
+        stages are returned if the plate is finished.
+        """
+        stages=settings['stages']
+        record=self.plates.get(file)
+        if (record is None or record['settings'] != settings or
+            record['input'] != inputs):
+            return stages, None
+        done=[stage for stage, outputs in record['stages'].iteritems()
+              if all(file_hash(f) == h for f, h in outputs.iteritems())]
+        todo=[stage for stage in stages if stage not in done]
+        if not todo:
+            return [], None
+        if todo == ['images'] and 'write' in done:
+            return todo, record['stages']['write'].keys()[0]
+        return stages, None
+
+    def record(self, file, settings, inputs, result, resumed=False):
+        """
+        Record the result of batch_hole_map.run_plate for file, run with
+        settings and the input hashes inputs taken before it was run, resumed
+        if the stages run continued from an earlier run
+        """
+        old=self.plates.get(file)
+        if resumed and old is not None:
+            record=old
+        else:
+            record={'stages':{}, 'attempts':old['attempts'] if old else 0}
+            self.plates[file]=record
+        record['input']=inputs
+        record['settings']=settings
+        for stage, outputs in result['outputs'].iteritems():
+            record['stages'][stage]={f:file_hash(f) for f in outputs}
+        record['error']=result['error']
+        if result['infeasible']:
+            record['status']='infeasible'
+        elif result['error']:
+            record['status']='failed'
+        else:
+            record['status']='done'
+        record['attempts']=record['attempts']+1 if result['error'] else 0
+
+def _run_plate(conn, task):
+    conn.send(batch_hole_map._run_plate(task))
+    conn.close()
+
+def run_isolated(tasks, workers=1):
+    """
+    Yield the batch_hole_map.run_plate results for tasks, each run in a new
+    process, at most workers at a time. A plate whose process dies gets a
+    result with an error.
+    """
+    pending=list(tasks)
+    running=[]
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                task=pending.pop(0)
+                recv, send=multiprocessing.Pipe(False)
+                proc=multiprocessing.Process(target=_run_plate,
+                                             args=(send, task))
+                proc.start()
+                send.close()
+                running.append((proc, recv, task))
+
+            for entry in list(running):
+                proc, recv, task=entry
+                if not recv.poll():
+                    continue
+                try:
+                    result=recv.recv()
+                except EOFError:
+                    #The process died without sending a result
+                    proc.join()
+                    result={'file':task[0], 'times':{}, 'outputs':{},
+                            'error':'Process exited with code {}'.format(
+                                    proc.exitcode),
+                            'infeasible':False}
+                proc.join()
+                running.remove(entry)
+                yield result
+            time.sleep(POLL_SECONDS)
+    finally:
+        for proc, _, _ in running:
+            proc.terminate()
+
+def batch_runner(platefiles, checkpoint, stages=batch_hole_map.STAGES,
+                 groups=(), outdir=None, workers=1, compress_level=6,
+                 retries=1, in_place=False):
+    """
+    Run stages on the platefiles not finished according to checkpoint, then
+    retry the failed ones up to retries times each, saving checkpoint after
+    each plate. Returns the last result for each plate run.
+    """
+    #Lists, as the settings are read back from the checkpoint
+    settings={'stages':list(stages), 'groups':[list(g) for g in groups],
+              'outdir':outdir, 'compress_level':compress_level,
+              'in_place':in_place}
+    image_options={'compress_level':compress_level}
+
+    tasks={}
+    inputs={}
+    for file in platefiles:
+        inputs[file]=input_hashes(file)
+        todo, source=checkpoint.plan(file, settings, inputs[file])
+        if todo:
+            tasks[file]=(file, todo, groups, outdir, image_options, source,
+                         in_place)
+        else:
+            print file, 'finished'
+
+    start=time.time()
+    results={}
+    def finish(result):
+        file=result['file']
+        checkpoint.record(file, settings, inputs[file], result,
+                          resumed=tasks[file][5] is not None)
+        checkpoint.save()
+        batch_hole_map.print_result(result)
+        results[file]=result
+
+    for result in run_isolated([tasks[f] for f in platefiles if f in tasks],
+                               workers):
+        finish(result)
+
+    for attempt in range(retries):
+        failed=[f for f in platefiles if f in results and
+                results[f]['error'] and not results[f]['infeasible']]
+        if not failed:
+            break
+        print 'Retrying {} plates'.format(len(failed))
+        for result in run_isolated([tasks[f] for f in failed]):
+            finish(result)
+
+    failed=len([r for r in results.itervalues() if r['error']])
+    print 'Ran {} plates, {} failed, skipped {}, in {:.2f}s'.format(
+            len(results), failed, len(platefiles)-len(tasks),
+            time.time()-start)
+    return results.values()
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Run the batch_hole_map.py '
+                                   'stages on plates, skipping work done by '
+                                   'earlier runs',
+                                   epilog='Exits with status 2 if a setup '
+                                   "couldn't be assigned, 1 on other errors")
+    batch_hole_map.add_arguments(parser)
+    parser.add_argument('-c', '--checkpoint', default='batch_checkpoint.json',
+                        help='Checkpoint file, default %(default)s')
+    parser.add_argument('-r', '--retries', type=int, default=1,
+                        help='Times to retry failed plates, default '
+                        '%(default)s')
+    args, files, stages, groups=batch_hole_map.parse_arguments(parser)
+
+    outdir=args.outdir and os.path.abspath(args.outdir)
+    results=batch_runner([os.path.abspath(f) for f in files],
+                         Checkpoint(args.checkpoint), stages=stages,
+                         groups=groups, outdir=outdir,
+                         workers=args.workers,
+                         compress_level=args.compress_level,
+                         retries=args.retries, in_place=args.in_place)
+    sys.exit(batch_hole_map.exit_status(results))
@@ -0,0 +1,210 @@
+#! /usr/bin/env python
+'''
+Time the main operations of hole mapper on synthetic plates
+
+A plate is generated with synthetic_plates.py and the time taken by
+Plate.load of its .asc/.res and .plate files, assignFibers of each setup and
+of the first two setups assigned together, plateHoleInfo.write_platefile,
+Plate.draw on a canvas that only counts the drawing calls and
+Plate.drawImage to an ImageCanvas, rendered, are written as JSON so changes
+can be compared.
+'''
+import argparse
+import json
+import os.path
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import timeit
+from collections import defaultdict
+import Plate
+import ImageCanvas
+import deadfibers
+import synthetic_plates
+
+class StubCanvas(object):
+    """
+    A canvas with the geometry of the plate canvas of hole_map_gui.py that
+    counts the drawing calls made, by call, in place of drawing
+    """
+    def __init__(self, width=768, height=768, units_hwidth=1.01,
+                 units_hheight=1.01, bg='White'):
+        self.bg=bg
+        self.centerx=float(width)/2.0
+        self.centery=float(height)/2.0
+        self.scalex=self.centerx/units_hwidth
+        self.scaley=self.centery/units_hheight
+        self.calls=defaultdict(int)
+
+    def _call(self, name):
+        self.calls[name]+=1
+        return sum(self.calls.itervalues())
+
+    def drawBackground(self, image):
+        self._call('drawBackground')
+
+    def drawCircle(self, pos, r, **kw):
+        return self._call('drawCircle')
+
+    def drawCircles(self, points, r, **kw):
+        return [self._call('drawCircles') for p in points]
+
+    def drawSquare(self, pos, len, **kw):
+        return self._call('drawSquare')
+
+    def drawRectangle(self, rect, **kw):
+        return self._call('drawRectangle')
+
+    def drawLine(self, *args, **kw):
+        return self._call('drawLine')
+
+    def drawLines(self, segments, **kw):
+        return self._call('drawLines')
+
+    def drawPolyline(self, points, **kw):
+        return self._call('drawPolyline')
+
+    def drawText(self, pos, text, **kw):
+        return self._call('drawText')
+
+    def getTextSize(self, text):
+        return 7.0*len(text)/self.scalex, 12.0/self.scaley
+
+def timed(func, repeat, setup=None):
+    """
+    Time repeat calls of func, passing it the return value of setup, which
+    isn't timed, if given. Returns a dict of the 'best' and 'mean' seconds
+    and the number of 'runs'.
+    """
+    times=[]
+    for i in range(repeat):
+        args=setup() if setup else None
+        start=timeit.default_timer()
+        if setup:
+            func(args)
+        else:
+            func()
+        times.append(timeit.default_timer()-start)
+    return {'best':min(times), 'mean':sum(times)/len(times), 'runs':repeat}
+
+def _revision():
+    """The git revision of the code being timed, None if unknown"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                    cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(dir, repeat=3, **params):
+    """
+    Generate a plate in dir with synthetic_plates.generate(**params) and time
+    the benchmarks on it. Returns a dict of the results by benchmark.
+    """
+    files=synthetic_plates.generate('Bench', outdir=dir, **params)
+    asc, _, platefile=files[:3]
+    if params.get('dead'):
+        deadfibers.reload(files[3])
+
+    def loaded(file=asc):
+        p=Plate.Plate()
+        p.load(file)
+        return p
+
+    def assign_all(p):
+        for s in sorted(p.setups):
+            p.assignFibers(s, [])
+
+    assigned=loaded()
+    assign_all(assigned)
+    active=sorted(assigned.setups)[0]
+
+    results={}
+    results['load_asc']=timed(lambda: loaded(asc), repeat)
+    results['load_plate']=timed(lambda: loaded(platefile), repeat)
+    results['assign']=timed(assign_all, repeat, setup=loaded)
+    if len(assigned.setups) > 1:
+        results['assign_awith']=timed(
+                lambda p: p.assignFibers('Setup 1', ['2']), repeat,
+                setup=loaded)
+    outfile=os.path.join(dir, 'Bench_written.plate')
+    results['write_platefile']=timed(
+            lambda: assigned.plateHoleInfo.write_platefile(outfile), repeat)
+
+    #Only the first draw renders the background image of the inactive holes,
+    # as in the GUI the later ones reuse it
+    canvas=StubCanvas()
+    results['draw']=timed(lambda: assigned.draw(canvas, active_setup=active),
+                          repeat)
+    results['draw']['calls']=dict((k, v/repeat)
+                                  for k, v in canvas.calls.iteritems())
+
+    def draw_image():
+        canvas=ImageCanvas.ImageCanvas(1280, 1280, 1.0, 1.0)
+        assigned.drawImage(canvas, active_setup=active)
+        canvas.render()
+    results['draw_image']=timed(draw_image, repeat)
+    return results
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Time hole mapper operations '
+                                   'on a synthetic plate, writing the results '
+                                   'as JSON')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='JSON results file, default %(default)s')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Times to run each benchmark, default '
+                        '%(default)s')
+    parser.add_argument('--setups', type=int, default=3,
+                        help='Number of setups, default %(default)s')
+    parser.add_argument('--targets', type=int, default=120,
+                        help='Science and sky holes per setup, default '
+                        '%(default)s')
+    parser.add_argument('--sky', type=float, default=0.15,
+                        help='Fraction of targets that are sky, default '
+                        '%(default)s')
+    parser.add_argument('--slits', default='180,125',
+                        help='Comma separated slit widths for the .plate '
+                        'file, default %(default)s')
+    parser.add_argument('--preset', type=float, default=1.0,
+                        help='Fraction of targets plugged in the .plate file, '
+                        'default %(default)s')
+    parser.add_argument('--dead', type=int, default=9,
+                        help='Number of dead fibers, default %(default)s')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, default %(default)s')
+    parser.add_argument('--keep', metavar='DIR', default=None,
+                        help='Generate the plate files in DIR and keep them')
+    args=parser.parse_args()
+
+    params={'setups':args.setups, 'targets':args.targets,
+            'sky_fraction':args.sky,
+            'slits':[int(s) for s in args.slits.split(',') if s.strip()],
+            'preset':args.preset, 'dead':args.dead, 'seed':args.seed}
+
+    dir=args.keep or tempfile.mkdtemp()
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    try:
+        results=run_benchmarks(dir, repeat=args.repeat, **params)
+    finally:
+        if not args.keep:
+            shutil.rmtree(dir)
+
+    report={'created':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision':_revision(),
+            'python':platform.python_version(),
+            'platform':platform.platform(),
+            'repeat':args.repeat,
+            'params':params,
+            'results':results}
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=1, sort_keys=True)
+
+    for name in sorted(results):
+        print '{:16} best {:.4f}s mean {:.4f}s'.format(name,
+                                                       results[name]['best'],
+                                                       results[name]['mean'])
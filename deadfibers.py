@@ -0,0 +1,68 @@
+'''
+Dead fiber registry
+
+The dead fibers are recorded in the versioned state file dead_fibers.cfg. The
+registry is loaded once per process into an immutable fiber mask (rows are
+Cassette.CASSETTE_NAMES, columns fiber numbers) which is true for dead fibers.
+Call reload() to pick up edits to the file in a running process.
+'''
+import ConfigParser
+import os.path
+import numpy as np
+import Cassette
+
+STATE_FILE=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'dead_fibers.cfg')
+
+_registry=None
+
+
+def load(file=STATE_FILE):
+    """
+    Read a dead fiber state file and return (version, mask), the mask is
+    read only
+    """
+    parser=ConfigParser.RawConfigParser()
+    with open(file,'r') as fp:
+        parser.readfp(fp)
+    version=parser.get('State', 'version')
+    mask=np.zeros((len(Cassette.CASSETTE_NAMES), Cassette.N_FIBERS),
+                  dtype=bool)
+    for fiber in parser.get('DeadFibers', 'fibers').split(','):
+        fiber=fiber.strip().upper()
+        if not fiber:
+            continue
+        try:
+            number=int(fiber.split('-')[1])
+            if not 1 <= number <= Cassette.N_FIBERS:
+                raise ValueError
+            row=Cassette.CASSETTE_INDEX[Cassette.fiber2cassettename(fiber)]
+        except (KeyError, IndexError, ValueError):
+            raise ValueError('Invalid dead fiber {} in {}'.format(fiber, file))
+        mask[row, number-1]=True
+    mask.flags.writeable=False
+    return version, mask
+
+def registry():
+    """Return the (version, mask) of the dead fiber registry"""
+    global _registry
+    if _registry is None:
+        _registry=load()
+    return _registry
+
+def reload(file=None):
+    """
+    Reread the dead fiber state file, or read file in its place, returns the
+    new (version, mask)
+    """
+    global _registry
+    _registry=load(file) if file else None
+    return registry()
+
+def dead_fiber_mask():
+    """Return the immutable mask of dead fibers"""
+    return registry()[1]
+
+def version():
+    """Return the version of the dead fiber registry"""
+    return registry()[0]
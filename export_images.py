@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+'''
+Render the projector images for every setup and channel of plates
+
+Writes the same images as the Make Image buttons of hole_map_gui.py, as
+<outdir>/<plate file>_<setup>_<channel>.png, rendering the plates in a pool
+of worker processes.
+'''
+import argparse
+import glob
+import itertools
+import multiprocessing
+import os.path
+import sys
+import time
+import Plate
+import ImageCanvas
+
+CHANNELS=['all', 'armR', 'armB']
+IMAGE_SIZE=1280
+
+def image_jobs(plate, file, outdir):
+    """
+    Return a list of (setup, channel, outfile) for every setup and channel of
+    plate, loaded from file
+    """
+    return [(setup, channel, image_file(outdir, file, setup, channel))
+            for setup in sorted(plate.setups) for channel in CHANNELS]
+
+def image_file(outdir, platefile, setup, channel):
+    """Return the name of the image of a setup and channel of platefile"""
+    return os.path.join(outdir, '_'.join([os.path.basename(platefile),
+                                          setup, channel])+'.png')
+
+def draw_image(plate, setup, channel, outfile, options):
+    """Render and save one image of plate"""
+    canvas=ImageCanvas.ImageCanvas(IMAGE_SIZE, IMAGE_SIZE, 1.0, 1.0)
+    plate.drawImage(canvas, channel=channel, active_setup=setup)
+    canvas.save(outfile, **options)
+
+def render_plate((file, outdir, options)):
+    """
+    Load a plate file and render and save the images of all its setups and
+    channels, options are passed on to ImageCanvas.save. Returns (error,
+    results) where error is None unless the plate could not be loaded and
+    results a list of (outfile, seconds, error) for each image, error being
+    None unless rendering failed.
+    """
+    try:
+        plate=Plate.Plate()
+        plate.load(file)
+    except Exception, e:
+        return 'Platefile Error: {}'.format(e), []
+    results=[]
+    for setup, channel, outfile in image_jobs(plate, file, outdir):
+        start=time.time()
+        try:
+            draw_image(plate, setup, channel, outfile, options)
+        except Exception, e:
+            results.append((outfile, time.time()-start,
+                            'Image Error: {}'.format(e)))
+        else:
+            results.append((outfile, time.time()-start, None))
+    return None, results
+
+def export_images(platefiles, outdir='.', workers=1, compress_level=6):
+    """
+    Render the images for platefiles into outdir using workers processes,
+    printing the time taken for each. Returns the number of failed images.
+    """
+    options={'compress_level':compress_level}
+    tasks=[(file, outdir, options) for file in platefiles]
+    
+    #Each worker loads the plates it renders, so the plates are never loaded
+    # or pickled by this process
+    if workers > 1:
+        pool=multiprocessing.Pool(workers)
+        results=pool.imap(render_plate, tasks)
+    else:
+        pool=None
+        results=itertools.imap(render_plate, tasks)
+    
+    start=time.time()
+    rendered=failed=0
+    try:
+        for file, (err, images) in itertools.izip(platefiles, results):
+            if err:
+                print file, err
+            for outfile, seconds, err in images:
+                if err:
+                    failed+=1
+                    print outfile, err
+                else:
+                    rendered+=1
+                    print '{} {:.2f}s'.format(outfile, seconds)
+    finally:
+        if pool:
+            pool.terminate()
+    print 'Rendered {} images in {:.2f}s'.format(rendered, time.time()-start)
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Render the projector images '
+                                   'for every setup and channel of plates')
+    parser.add_argument('files', nargs='*',
+                        help='Plate files or directories of plates, the '
+                        'current directory by default')
+    parser.add_argument('-o', '--outdir', default='.',
+                        help='Directory for the images')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Number of worker processes rendering images')
+    parser.add_argument('-z', '--compress-level', type=int, default=6,
+                        choices=range(10),
+                        help='PNG compression level, 0 is fastest')
+    args=parser.parse_args()
+    
+    files=[]
+    for f in args.files or ['.']:
+        if os.path.isdir(f):
+            files.extend(sorted(glob.glob(os.path.join(f, '*.plate'))))
+        else:
+            files.append(f)
+    
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    
+    failed=export_images(files, outdir=args.outdir, workers=args.workers,
+                         compress_level=args.compress_level)
+    sys.exit(1 if failed else 0)
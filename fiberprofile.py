@@ -0,0 +1,164 @@
+'''
+Per-program fiber usage profiles
+
+The rules restricting which fibers a program's setups may use are declared in
+fiber_profiles.cfg (see that file for the rule syntax). Each setup's rules are
+compiled once into a boolean fiber mask, with a row for each cassette in
+Cassette.CASSETTE_NAMES and a column for each fiber number, and the sky
+cassette groups for the setup, if the rules set them.
+'''
+import ConfigParser
+import os.path
+import numpy as np
+import Cassette
+
+PROFILE_FILE=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fiber_profiles.cfg')
+
+_FIBER_NUMBERS=np.arange(1, Cassette.N_FIBERS+1)
+_RED=np.array([name[0]=='R' for name in Cassette.CASSETTE_NAMES])
+
+_profiles=None
+_compiled={}
+
+
+class InvalidProfile(Exception):
+    """ Raised if a fiber profile rule can not be understood """
+    pass
+
+
+def load_profiles(file=PROFILE_FILE):
+    """
+    Return a list of (match, {setup_name:rules}) for the profiles in file, in
+    the order they appear in the file
+    """
+    parser=ConfigParser.RawConfigParser()
+    parser.optionxform=str
+    with open(file,'r') as fp:
+        parser.readfp(fp)
+    ret=[]
+    for section in parser.sections():
+        rules=dict(parser.items(section))
+        try:
+            match=rules.pop('match')
+        except KeyError:
+            raise InvalidProfile('Profile {} has no match'.format(section))
+        ret.append((match, rules))
+    return ret
+
+def profiles():
+    """Return the profiles from PROFILE_FILE, loading them the first time"""
+    global _profiles
+    if _profiles is None:
+        _profiles=load_profiles()
+    return _profiles
+
+def _cassette_names(names):
+    """
+    Expand a list of (half) cassette names, a name without h or l meaning
+    both halves, low first, keeping their order
+    """
+    ret=[]
+    for name in names:
+        if name in Cassette.CASSETTE_INDEX:
+            ret.append(name)
+        elif name+'l' in Cassette.CASSETTE_INDEX:
+            ret.extend([name+'l', name+'h'])
+        else:
+            raise InvalidProfile('Unknown cassette {}'.format(name))
+    return ret
+
+def _cassette_rows(names):
+    """Boolean array selecting the rows of the named cassettes"""
+    rows=np.zeros(len(Cassette.CASSETTE_NAMES), dtype=bool)
+    rows[[Cassette.CASSETTE_INDEX[name] for name in names]]=True
+    return rows
+
+def _fiber_list(s):
+    return [int(x) for x in s.split(',') if x.strip()]
+
+def compile_rules(rules):
+    """
+    Compile a setup's rule string into a (mask, cassette_groups) tuple,
+    cassette_groups is None if the rules don't set the sky groups. The result
+    is cached and must not be modified.
+    """
+    if rules in _compiled:
+        return _compiled[rules]
+
+    mask=Cassette.default_fiber_mask()
+    groups=None
+    overrides=[]
+    group=False
+    cassettes=None
+    for rule in rules.split():
+        key,_,value=rule.partition('=')
+        if key=='odds':
+            mask&=(_FIBER_NUMBERS % 2 == 1)
+        elif key=='evens':
+            mask&=(_FIBER_NUMBERS % 2 == 0)
+        elif key=='fibers':
+            mask&=np.in1d(_FIBER_NUMBERS, _fiber_list(value))
+        elif key=='cassettes':
+            cassettes=_cassette_names(value.split(','))
+            mask&=_cassette_rows(cassettes)[:,np.newaxis]
+        elif key=='red':
+            mask&=_RED[:,np.newaxis]
+            groups=[Cassette.red_cassette_names()]
+        elif key=='blue':
+            mask&=~_RED[:,np.newaxis]
+            groups=[Cassette.blue_cassette_names()]
+        elif key=='group':
+            group=True
+        elif key in Cassette.CASSETTE_INDEX:
+            overrides.append((key, _fiber_list(value)))
+        else:
+            raise InvalidProfile('Unknown rule {}'.format(rule))
+
+    for name, fibers in overrides:
+        row=Cassette.CASSETTE_INDEX[name]
+        allowed=Cassette.default_fiber_mask()[row]
+        fibers=np.array(fibers, dtype=int)
+        if not allowed[fibers-1].all():
+            raise InvalidProfile('Cassette {} has no fiber in {}'.format(
+                                 name, fibers.tolist()))
+        mask[row]=False
+        mask[row, fibers-1]=True
+
+    if group:
+        #In the order the cassettes are given, as it sets the assignment order
+        if cassettes is None:
+            cassettes=Cassette.CASSETTE_NAMES
+        groups=[[name for name in cassettes
+                 if mask[Cassette.CASSETTE_INDEX[name]].any()]]
+
+    mask.flags.writeable=False
+    _compiled[rules]=(mask, groups)
+    return _compiled[rules]
+
+def setup_masks(plate_name, setup_names):
+    """
+    Return a (masks, cassette_groups) tuple for the named setups of a plate.
+    masks is a len(setup_names) x n_cassettes x n_fibers boolean array, in the
+    order of setup_names, and cassette_groups a dict of the sky cassette groups
+    by setup name.
+
+    The setups named in the last profile matching plate_name use its rules,
+    replacing those of earlier profiles; the sky groups are only replaced if
+    the later rules set them.
+    """
+    masks=np.empty((len(setup_names), len(Cassette.CASSETTE_NAMES),
+                    Cassette.N_FIBERS), dtype=bool)
+    masks[:]=Cassette.default_fiber_mask()
+    groups={s:[Cassette.blue_cassette_names(), Cassette.red_cassette_names()]
+            for s in setup_names}
+    for match, setup_rules in profiles():
+        if match not in plate_name:
+            continue
+        for i, s in enumerate(setup_names):
+            if s in setup_rules:
+                mask, setup_groups=compile_rules(setup_rules[s])
+                masks[i]=mask
+                if setup_groups is not None:
+                    groups[s]=[list(g) for g in setup_groups]
+    return masks, groups
@@ -3,8 +3,13 @@ import Tkinter
 import BetterCanvas
 import ImageCanvas
 import Plate
+import deadfibers
 import tkMessageBox
 import os
+import glob
+import threading
+import PIL.ImageTk
+from plateindex import PlateIndex
 
 #mainloop
 #meat: plate.loadHoles then self.show
@@ -16,9 +21,9 @@ class HoleInfoDialog:
         self.canvas=canvas
         self.parent=parent
         self.setup=setup
-        self.getHoleInfo=lambda a:plate.getHoleInfo(a)
-        self.getFiberForHole=lambda a:plate.getFiberForHole(a, setup)
-        self.getChannelForHole=lambda a:plate.getChannelForHole(a, setup)
+        self.getDrawnItems=lambda a:plate.getDrawnItems(canvas, a)
+        self.getHoleInfo=lambda a:plate.getHoleInfo(a, setup)
+        self.getHoleInfoBatch=lambda a:plate.getHoleInfoBatch(a, setup)
         
         if len(holeIDs) > 1:
             self.initializeSelection(holeIDs)
@@ -33,16 +38,15 @@ class HoleInfoDialog:
         
         self.holeID=holeIDs
         
-        for i,id in enumerate(holeIDs):
+        infos=self.getHoleInfoBatch(holeIDs)
+        for i,(id,info) in enumerate(zip(holeIDs, infos)):
             
             self.add_callback_for_id(id)
             
-            self.canvas.itemconfigure('.'+id, state=Tkinter.DISABLED)
-
-            info=self.getHoleInfo(id)
+            self.setHoleState(id, Tkinter.DISABLED)
             
             lbl_str=' '.join(['ID:',id,'Type:',info['TYPE'],'Targ ID:',
-                               info['ID'],'other info'])
+                               info['ID'],'Fiber:',info.get('FIBER','None')])
             Tkinter.Label(self.dialog, text=lbl_str).grid(row=i,column=0)
             
             Tkinter.Button(self.dialog,text='Select',command=getattr(self,'cb'+id)).grid(row=i,column=1)
@@ -50,7 +54,7 @@ class HoleInfoDialog:
 
     def initializeSingle(self, holeID):
 
-        self.canvas.itemconfigure('.'+holeID,state=Tkinter.DISABLED)
+        self.setHoleState(holeID, Tkinter.DISABLED)
         self.dialog=Tkinter.Toplevel(self.parent)
         self.dialog.bind("<FocusOut>", self.defocusCallback)
         self.dialog.bind("<Destroy>", self.destroyCallback)
@@ -71,8 +75,8 @@ class HoleInfoDialog:
                 Tkinter.Label(self.dialog, text='Color: %f'%info['COLOR']).pack(anchor='w')
             
             Tkinter.Label(self.dialog, text='Setup Specific Information').pack()
-            Tkinter.Label(self.dialog, text="Channel: "+self.getChannelForHole(holeID)).pack(anchor='w')
-            Tkinter.Label(self.dialog, text="Assigned Fiber: "+self.getFiberForHole(holeID)).pack(anchor='w')
+            Tkinter.Label(self.dialog, text="Channel: "+info.get('CHANNEL','')).pack(anchor='w')
+            Tkinter.Label(self.dialog, text="Assigned Fiber: "+info.get('FIBER','None')).pack(anchor='w')
 
         Tkinter.Button(self.dialog,text='Done',command=self.ok).pack()
 
@@ -105,13 +109,317 @@ class HoleInfoDialog:
         
     def resetHoles(self):
         if isinstance(self.holeID, str):
-            self.canvas.itemconfig('.'+self.holeID,state=Tkinter.NORMAL)
+            self.setHoleState(self.holeID, Tkinter.NORMAL)
         else:
             for id in self.holeID:
-                self.canvas.itemconfig('.'+id,state=Tkinter.NORMAL)
+                self.setHoleState(id, Tkinter.NORMAL)
+
+    def setHoleState(self, holeID, state):
+        for item in self.getDrawnItems(holeID):
+            self.canvas.itemconfig(item, state=state)
+        
+
+
+class PlateBrowser:
+    """
+    List the .plate files in a directory along with their setups, using a
+    PlateIndex in the directory so only new or changed plates are parsed.
+    The index is brought up to date in a worker thread.
+    """
+    POLL_MS=100
+    
+    def __init__(self, parent, dir, loadcallback):
+        self.loadcallback=loadcallback
+        self.dir=dir
+        self.files=sorted(glob.glob(os.path.join(dir, '*.plate')))
+        self.summaries=None
+        
+        self.dialog=Tkinter.Toplevel(parent)
+        self.dialog.title('Plates in '+dir)
+        
+        self.list=Tkinter.Listbox(self.dialog, width=60, height=20)
+        self.list.pack(fill=Tkinter.BOTH, expand=1)
+        self.list.bind('<<ListboxSelect>>', self.selectCallback)
+        self.list.bind('<Double-Button-1>', self.load)
+        
+        self.info_str=Tkinter.StringVar(value='Indexing {} plates...'.format(
+                                        len(self.files)))
+        Tkinter.Label(self.dialog, textvariable=self.info_str,
+                      justify=Tkinter.LEFT, font='TkFixedFont').pack(anchor='w')
+        Tkinter.Button(self.dialog, text='Load', command=self.load).pack()
+        
+        self.result=None
+        self.finished=False
+        thread=threading.Thread(target=self.run)
+        thread.daemon=True
+        thread.start()
+        self.dialog.after(self.POLL_MS, self.poll)
+    
+    def run(self):
+        #The index connection must be used only by the thread that opened it
+        try:
+            index=PlateIndex(os.path.join(self.dir, 'plate_index.sqlite'))
+            try:
+                self.result=index.summaries(self.files)
+            finally:
+                index.close()
+        except Exception, e:
+            self.result=[(None, 'Could not index plates: {}'.format(e))
+                         for f in self.files]
+        self.finished=True
+    
+    def poll(self):
+        if not self.dialog.winfo_exists():
+            return
+        if not self.finished:
+            self.dialog.after(self.POLL_MS, self.poll)
+            return
+        self.summaries=self.result
+        for f, (summary, err) in zip(self.files, self.summaries):
+            if summary:
+                self.list.insert(Tkinter.END, '{:<30} {} setups'.format(
+                                 summary['name'], summary['n_setups']))
+            else:
+                self.list.insert(Tkinter.END, '{:<30} error'.format(
+                                 os.path.basename(f)))
+        self.info_str.set('')
+
+    def selected(self):
+        sel=self.list.curselection()
+        if sel:
+            return int(sel[0])
+        return None
+    
+    def selectCallback(self, event):
+        i=self.selected()
+        if i is None:
+            return
+        summary, err=self.summaries[i]
+        if not summary:
+            self.info_str.set(err)
+            return
+        lines=['{:<11} {:<12} {:<12} {:<7} {:<11} {:<5} {}'.format(
+               'Name', 'RA', 'DE', 'Epoch', 'ST', 'Air', 'N')]
+        for attrib in summary['setups']:
+            lines.append('{name:<11} {ra:<12} {de:<12} {epoch:<7} '
+                         '{sidereal_time:<11} {airmass:<5} {n}'.format(**attrib))
+        self.info_str.set('\n'.join(lines))
+    
+    def load(self, *args):
+        i=self.selected()
+        if i is None:
+            return
+        self.dialog.destroy()
+        self.loadcallback(self.files[i])
+
+
+class ProjectorRenderer:
+    """
+    Renders the projector image of a plate setup in a background thread and
+    shows it on a canvas as a single image item. The image's display list is
+    recorded from the plate on the Tk thread, so the thread never touches the
+    plate. The last finished image stays up until a newer one is ready, and
+    requests made while rendering are collapsed into the most recent one.
+    failed is called on the Tk thread with a message if rendering fails.
+    """
+    POLL_MS=30
+    
+    def __init__(self, canvas, width, height, failed):
+        self.canvas=canvas
+        self.size=(width, height)
+        self.failed=failed
+        self.lock=threading.Lock()
+        self.generation=0    #of the most recent request
+        self.shown=0         #generation of the image on the canvas
+        self.request=None
+        self.frame=None
+        self.error=None
+        self.busy=False
+        self.polling=False
+        self.item=None
+        self.photo=None
+    
+    def draw(self, plate, setup, channel='all'):
+        """Request the image for setup & channel of plate"""
+        imgcanvas=ImageCanvas.ImageCanvas(self.size[0], self.size[1],
+                                          1.0, 1.0)
+        plate.drawImage(imgcanvas, channel=channel, radmult=1.1,
+                        active_setup=setup)
+        with self.lock:
+            self.generation+=1
+            self.request=(self.generation, imgcanvas)
+            start=not self.busy
+            self.busy=True
+        if start:
+            thread=threading.Thread(target=self.work)
+            thread.daemon=True
+            thread.start()
+        if not self.polling:
+            self.polling=True
+            self.canvas.after(self.POLL_MS, self.poll)
+    
+    def work(self):
+        while True:
+            with self.lock:
+                request=self.request
+                self.request=None
+                if request is None:
+                    self.busy=False
+                    return
+            generation, imgcanvas=request
+            try:
+                image=imgcanvas.render()
+            except Exception, e:
+                with self.lock:
+                    self.error='Projector image failed: {}'.format(e)
+                continue
+            with self.lock:
+                self.frame=(generation, image)
+    
+    def poll(self):
+        with self.lock:
+            frame=self.frame
+            self.frame=None
+            error=self.error
+            self.error=None
+            busy=self.busy
+        if error:
+            self.failed(error)
+        if frame and frame[0] > self.shown:
+            self.shown=frame[0]
+            #Swap the finished image in, PhotoImages belong to the main thread
+            self.photo=PIL.ImageTk.PhotoImage(frame[1])
+            if self.item is None:
+                self.item=self.canvas.create_image(0, 0, anchor=Tkinter.NW,
+                                                   image=self.photo)
+            else:
+                self.canvas.itemconfig(self.item, image=self.photo)
+        if busy:
+            self.canvas.after(self.POLL_MS, self.poll)
+        else:
+            self.polling=False
+
+
+class RegionifyTask:
+    """
+    Runs Plate.regionify in a worker thread behind a dialog showing its
+    progress with a button to cancel it. done is called on the Tk thread
+    when it finishes with None or a message describing why it failed.
+    """
+    POLL_MS=100
+    
+    def __init__(self, parent, plate, setup_number, awith, done):
+        self.parent=parent
+        self.done=done
+        self.cancel=threading.Event()
+        self.progress=None
+        self.error=None
+        self.finished=False
         
+        self.dialog=Tkinter.Toplevel(parent)
+        self.dialog.title('Regionify Setup '+setup_number)
+        self.status_str=Tkinter.StringVar(value='Starting')
+        Tkinter.Label(self.dialog, textvariable=self.status_str,
+                      width=40).pack()
+        Tkinter.Button(self.dialog, text='Cancel',
+                       command=self.cancel.set).pack()
+        self.dialog.protocol('WM_DELETE_WINDOW', self.cancel.set)
         
+        thread=threading.Thread(target=self.run,
+                                args=(plate, setup_number, awith))
+        thread.daemon=True
+        thread.start()
+        self.parent.after(self.POLL_MS, self.poll)
+    
+    def run(self, plate, setup_number, awith):
+        try:
+            plate.regionify(setup_number=setup_number, awith=awith,
+                            progress=self.report, cancel=self.cancel)
+        except Plate.AssignmentCancelled:
+            pass
+        except Plate.InfeasibleSetup, e:
+            self.error=str(e)
+        except Exception, e:
+            self.error='Regionify failed: {}'.format(e)
+        self.finished=True
+    
+    def report(self, stage, done, total):
+        self.progress=(stage, done, total)
+    
+    def poll(self):
+        if not self.finished:
+            if self.cancel.is_set():
+                self.status_str.set('Cancelling')
+            elif self.progress:
+                self.status_str.set('Assigning {} holes: {} of {}'.format(
+                                    *self.progress))
+            self.parent.after(self.POLL_MS, self.poll)
+            return
+        self.dialog.destroy()
+        self.done(self.error)
+
+
+class PlateLoadTask:
+    """
+    Loads a plate file into a new Plate in a worker thread, showing its
+    progress in status, a StringVar. done is called on the Tk thread when it
+    finishes with the task, the plate, and None or a message describing why
+    loading failed.
+    """
+    POLL_MS=100
+    
+    def __init__(self, parent, file, status, done):
+        self.parent=parent
+        self.file=file
+        self.status=status
+        self.done=done
+        self.plate=Plate.Plate()
+        self.progress=None
+        self.error=None
+        self.finished=False
+        self.superseded=False
+        
+        thread=threading.Thread(target=self.run)
+        thread.daemon=True
+        thread.start()
+        self.parent.after(self.POLL_MS, self.poll)
+    
+    def run(self):
+        try:
+            if not os.path.isfile(self.file):
+                raise IOError('No such file')
+            self.plate.load(self.file, progress=self.report)
+        except Exception, e:
+            self.error='Could not load {}: {}'.format(
+                        os.path.basename(self.file), e)
+        self.finished=True
+    
+    def report(self, setups_done, n_setups, n_holes):
+        self.progress=(setups_done, n_setups, n_holes)
+    
+    def poll(self):
+        if self.superseded:
+            return
+        if not self.finished:
+            if self.progress:
+                self.status.set('Loading {}: {} of {} setups, {} holes'.format(
+                                os.path.basename(self.file), *self.progress))
+            self.parent.after(self.POLL_MS, self.poll)
+            return
+        self.done(self, self.plate, self.error)
+
+
 class App(Tkinter.Tk):
+    #Milliseconds after the last coordinate parameter edit to wait before
+    # redrawing the projector, and before redrawing everything
+    PREVIEW_MS=100
+    SETTLE_MS=750
+    #Coordinate parameters in the order they must be set, with the amount
+    # the Up and Down keys change them by
+    COORD_PARAMS=(('D', 0.1), ('rm', 0.01), ('R', 0.01), ('a', 0.001))
+    #Pixels the mouse must be dragged to start a rubber band selection
+    BAND_MIN_DRAG=4
+    
     def __init__(self, parent):
         Tkinter.Tk.__init__(self, parent)
         self.parent = parent
@@ -121,6 +429,14 @@ class App(Tkinter.Tk):
 
         self.plate=Plate.Plate()
         self.file_str=Tkinter.StringVar(value='No File Loaded')
+        self.regionify=None
+        self.band=None
+        self.hovered=None
+        self.loading=None
+        self.channel='all'
+        self.preview_job=None
+        self.settle_job=None
+        self.settled=True
         
         #Basic window stuff
         swid=120
@@ -143,25 +459,37 @@ class App(Tkinter.Tk):
         #The canvas for drawing the plate        
         self.canvas=BetterCanvas.BetterCanvas(self, chei, chei, 1.01, 1.01, bg='White')
         self.canvas.place(x=swid,y=0)
-        self.canvas.bind("<Button-1>",self.canvasclick)
-
-
-        #Buttons
-        Tkinter.Button(frame, text="Show All", command=self.show).pack()
-        Tkinter.Button(frame, text="Show Red", 
-                       command=lambda:self.show(channel='armR')).pack()
-        Tkinter.Button(frame, text="Show Blue", 
-                       command=lambda:self.show(channel='armB')).pack()
-        Tkinter.Button(frame, text="Make Image", command=self.makeImage).pack()
-        Tkinter.Button(frame, text="Make R Image", 
-                       command=lambda:self.makeImage(channel='armR')).pack()
-        Tkinter.Button(frame, text="Make B Image", 
-                       command=lambda:self.makeImage(channel='armB')).pack()
-        Tkinter.Button(frame, text="Load Holes", command=self.load).pack()
-        Tkinter.Button(frame, text="Regionify", command=self.makeRegions).pack()
-        Tkinter.Button(frame, text="Gen .plate", command=self.genPlate).pack()
+        self.canvas.bind("<Button-1>",self.startBand)
+        self.canvas.bind("<B1-Motion>",self.dragBand)
+        self.canvas.bind("<ButtonRelease-1>",self.endBand)
+        self.canvas.bind("<Motion>",self.hover)
+
+
+        #Buttons, those using the plate are disabled while Regionify runs
+        self.plate_buttons=[]
+        def button(plate=True, **kw):
+            b=Tkinter.Button(frame, **kw)
+            b.pack()
+            if plate:
+                self.plate_buttons.append(b)
+        #Shows while Regionify runs are made once it finishes
+        button(plate=False, text="Show All", command=self.show)
+        button(plate=False, text="Show Red", 
+               command=lambda:self.show(channel='armR'))
+        button(plate=False, text="Show Blue", 
+               command=lambda:self.show(channel='armB'))
+        button(text="Make Image", command=self.makeImage)
+        button(text="Make R Image", 
+               command=lambda:self.makeImage(channel='armR'))
+        button(text="Make B Image", 
+               command=lambda:self.makeImage(channel='armB'))
+        button(text="Load Holes", command=self.load)
+        button(text="Browse Plates", command=self.browse)
+        button(text="Regionify", command=self.makeRegions)
+        button(text="Gen .plate", command=self.genPlate)
+        button(text="Dead Fibers", command=self.reloadDeadFibers)
         self.coordshft_str=Tkinter.StringVar(value='CShift On')
-        Tkinter.Button(frame, textvariable=self.coordshft_str, command=self.toggleCoord).pack()
+        button(textvariable=self.coordshft_str, command=self.toggleCoord)
 
         #Input
         #Setup input
@@ -208,41 +536,45 @@ class App(Tkinter.Tk):
         Dframe.grid(row=0,column=0)
         entry=Tkinter.Entry(Dframe, validate='focusout', width=paramw,
             invcmd=lambda:tkMessageBox.showerror('Bad D','Not a value for D.'),
-            vcmd=lambda:self.plate.isValidCoordParam_D(self.Dparam_str.get()),
+            vcmd=lambda:self.plate.isValidCoordShift(**self.enteredCoordParams()),
             textvariable=self.Dparam_str)
         entry.pack()
-        #entry.bind("<FocusOut>",self.setCoordShiftD)
-        entry.bind("<Return>",self.setCoordShiftD)
+        #entry.bind("<FocusOut>",self.setCoordParams)
+        entry.bind("<Return>",self.setCoordParams)
+        self.bindCoordParamPreview(entry, 'D')
 
         rmframe=Tkinter.LabelFrame(pframe,text='rm',relief='flat')
         rmframe.grid(row=0,column=1)
         entry=Tkinter.Entry(rmframe, validate='focusout', width=paramw,
             invcmd=lambda:tkMessageBox.showerror('Bad rm','Not a value for rm.'),
-            vcmd=lambda:self.plate.isValidCoordParam_rm(self.rmparam_str.get()),
+            vcmd=lambda:self.plate.isValidCoordShift(**self.enteredCoordParams()),
             textvariable=self.rmparam_str)
         entry.pack()
-        #entry.bind("<FocusOut>",self.setCoordShiftrm)
-        entry.bind("<Return>",self.setCoordShiftrm)
+        #entry.bind("<FocusOut>",self.setCoordParams)
+        entry.bind("<Return>",self.setCoordParams)
+        self.bindCoordParamPreview(entry, 'rm')
         
         Rframe=Tkinter.LabelFrame(pframe,text='R',relief='flat')
         Rframe.grid(row=1,column=0)
         entry=Tkinter.Entry(Rframe, validate='focusout', width=paramw,
             invcmd=lambda:tkMessageBox.showerror('Bad R','Not a value for R.'),
-            vcmd=lambda:self.plate.isValidCoordParam_R(self.Rparam_str.get()),
+            vcmd=lambda:self.plate.isValidCoordShift(**self.enteredCoordParams()),
             textvariable=self.Rparam_str)
         entry.pack()
-        #entry.bind("<FocusOut>",self.setCoordShiftR)
-        entry.bind("<Return>",self.setCoordShiftR)
+        #entry.bind("<FocusOut>",self.setCoordParams)
+        entry.bind("<Return>",self.setCoordParams)
+        self.bindCoordParamPreview(entry, 'R')
 
         aframe=Tkinter.LabelFrame(pframe,text='a',relief='flat')
         aframe.grid(row=1,column=1)
         entry=Tkinter.Entry(aframe, validate='focusout', width=paramw,
             invcmd=lambda:tkMessageBox.showerror('Bad a','Not a value for a.'),
-            vcmd=lambda:self.plate.isValidCoordParam_a(self.aparam_str.get()),
+            vcmd=lambda:self.plate.isValidCoordShift(**self.enteredCoordParams()),
             textvariable=self.aparam_str)
         entry.pack()
-        #entry.bind("<FocusOut>",self.setCoordShifta)
-        entry.bind("<Return>",self.setCoordShifta)
+        #entry.bind("<FocusOut>",self.setCoordParams)
+        entry.bind("<Return>",self.setCoordParams)
+        self.bindCoordParamPreview(entry, 'a')
 
         #Info output
         self.info_str=Tkinter.StringVar(value='Red: 000  Blue: 000  Total: 0000')
@@ -258,6 +590,8 @@ class App(Tkinter.Tk):
             return []
     
     def toggleCoord(self):
+        if self.regionify:
+            return
         self.plate.toggleCoordShift()
         if self.plate.doCoordShift:
             self.coordshft_str.set('CShift On')
@@ -279,6 +613,8 @@ class App(Tkinter.Tk):
         
         self.proj_can=BetterCanvas.BetterCanvas(self.proj_win, 768,768, 1.00, 1.00, bg='Black')
         self.proj_can.place(x=-3,y=-3)
+        self.projector=ProjectorRenderer(self.proj_can, 768, 768,
+                            lambda msg: tkMessageBox.showerror('Projector', msg))
         self.show()
 
     def Move(self,event):
@@ -303,45 +639,91 @@ class App(Tkinter.Tk):
         #print '.'+self.proj_win.winfo_screen()+'.'
         self.moving['stat']=False    
     
+    def startBand(self, event):
+        if self.regionify:
+            return
+        self.band={'start':(event.x, event.y), 'item':None}
+
+    def dragBand(self, event):
+        """Show the rubber band selection rectangle once the mouse moves"""
+        if not self.band:
+            return
+        x0,y0=self.band['start']
+        if self.band['item'] is None:
+            if max(abs(event.x-x0), abs(event.y-y0)) < self.BAND_MIN_DRAG:
+                return
+            self.band['item']=self.canvas.create_rectangle(x0, y0,
+                                    event.x, event.y, outline='Blue', dash=(3,3))
+        else:
+            self.canvas.coords(self.band['item'], x0, y0, event.x, event.y)
+
+    def endBand(self, event):
+        """Show the holes in the rubber band rectangle, or under a click"""
+        band, self.band=self.band, None
+        if not band:
+            return
+        if band['item'] is None:
+            self.canvasclick(event)
+            return
+        self.canvas.delete(band['item'])
+        
+        x0,y0=band['start']
+        region=(self.canvas.inputCoordx(x0), self.canvas.inputCoordy(y0),
+                self.canvas.inputCoordx(event.x), self.canvas.inputCoordy(event.y))
+        holeIDs=tuple(str(h.hash) for h in self.plate.findHolesInRegion(region))
+        
+        if holeIDs:
+            HoleInfoDialog(self.parent, self.canvas, self.plate, self.getActiveSetup(), holeIDs)
+
+    def hover(self, event):
+        """
+        Highlight the hole under the mouse if it is in the background image,
+        Tk highlights the holes drawn as items
+        """
+        if self.regionify:
+            return
+        pos=(self.canvas.inputCoordx(event.x), self.canvas.inputCoordy(event.y))
+        holes=self.plate.findHoles(pos, tolerance=2.0/self.canvas.scalex)
+        item=None
+        if holes and self.plate.inBackground(self.canvas, holes[0].hash):
+            item=self.plate.getDrawnItems(self.canvas, holes[0].hash)[0]
+        if item==self.hovered:
+            return
+        if self.hovered and self.canvas.type(self.hovered):
+            self.canvas.itemconfig(self.hovered, fill='', outline='')
+        if item:
+            self.canvas.itemconfig(item, fill='Green', outline='Green')
+        self.hovered=item
+
     def canvasclick(self, event):
         #Get holes that are within a few pixels of the mouse position
-        items=self.canvas.find_overlapping(event.x - 2, event.y-2, event.x+2, event.y+2)
-        items=filter(lambda a: 'hole' in self.canvas.gettags(a), items)
+        pos=(self.canvas.inputCoordx(event.x), self.canvas.inputCoordy(event.y))
+        holes=self.plate.findHoles(pos, tolerance=2.0/self.canvas.scalex)
+        holeIDs=tuple(str(h.hash) for h in holes)
             
-        if items:
-            holeIDs=tuple([tag[1:] for i in items for tag in self.canvas.gettags(i) if tag[-1].isdigit()])
+        if holeIDs:
             HoleInfoDialog(self.parent, self.canvas, self.plate, self.getActiveSetup(), holeIDs)
 
 
-    def setCoordShiftD(self,*args):
-        if self.plate.isValidCoordParam_D(self.Dparam_str.get()):
-            self.plate.setCoordShiftD(self.Dparam_str.get())
+    def enteredCoordParams(self):
+        """Return a dict of the entered coordinate parameters by name"""
+        return {name:getattr(self, name+'param_str').get()
+                for name, _ in self.COORD_PARAMS}
+
+    def setCoordParams(self, *args):
+        """
+        Set the entered coordinate parameters if they are a valid set, else
+        restore the entries to the current parameters
+        """
+        if self.regionify:
+            return
+        entered=self.enteredCoordParams()
+        if self.plate.isValidCoordShift(**entered):
+            self.plate.setCoordShift(**entered)
         else:
-            self.Dparam_str.set(str(self.plate.coordShift_D))
-        if self.plate.doCoordShift:
-            self.show()
-
-    def setCoordShiftR(self,*args):
-        if self.plate.isValidCoordParam_R(self.Rparam_str.get()):
-            self.plate.setCoordShiftR(self.Rparam_str.get())
-        else:
-            self.Rparam_str.set(str(self.plate.coordShift_R))
-        if self.plate.doCoordShift:
-            self.show()
-    
-    def setCoordShiftrm(self,*args):
-        if self.plate.isValidCoordParam_rm(self.rmparam_str.get()):
-            self.plate.setCoordShiftrm(self.rmparam_str.get())
-        else:
-            self.rmparam_str.set(str(self.plate.coordShift_rm))
-        if self.plate.doCoordShift:
-            self.show()
-
-    def setCoordShifta(self,*args):
-        if self.plate.isValidCoordParam_a(self.aparam_str.get()):
-            self.plate.setCoordShifta(self.aparam_str.get())
-        else:
-            self.aparam_str.set(str(self.plate.coordShift_a))
+            for name, _ in self.COORD_PARAMS:
+                getattr(self, name+'param_str').set(
+                    str(getattr(self.plate, 'coordShift_'+name)))
         if self.plate.doCoordShift:
             self.show()
 
@@ -349,18 +731,114 @@ class App(Tkinter.Tk):
         return "Setup "+self.setup_str.get()
 
 
+    def bindCoordParamPreview(self, entry, name):
+        """Preview edits to a coordinate parameter entry as they are made"""
+        entry.bind("<KeyRelease>", lambda e: self.previewCoordParams())
+        entry.bind("<Up>", lambda e: self.nudgeCoordParam(name, 1))
+        entry.bind("<Down>", lambda e: self.nudgeCoordParam(name, -1))
+
+    def nudgeCoordParam(self, name, direction):
+        var=getattr(self, name+'param_str')
+        try:
+            value=float(var.get())
+        except ValueError:
+            return 'break'
+        step=dict(self.COORD_PARAMS)[name]
+        var.set(str(round(value+direction*step, 6)))
+        self.previewCoordParams()
+        return 'break'
+
+    def previewCoordParams(self):
+        """
+        Schedule a projector redraw with the entered coordinate parameters,
+        coalescing edits made within PREVIEW_MS, and a full redraw once edits
+        stop for SETTLE_MS
+        """
+        for job in (self.preview_job, self.settle_job):
+            if job:
+                self.after_cancel(job)
+        self.preview_job=self.after(self.PREVIEW_MS, self.applyCoordParams)
+        self.settle_job=self.after(self.SETTLE_MS, self.settleCoordParams)
+
+    def applyCoordParams(self):
+        """Set the entered coordinate parameters if valid & redraw the projector"""
+        self.preview_job=None
+        if self.regionify:
+            #Applied once Regionify finishes
+            return
+        #The parameters depend on each other so are validated as a set
+        entered=self.enteredCoordParams()
+        if not self.plate.isValidCoordShift(**entered):
+            return
+        old=self.plate.coordShiftKey()
+        self.plate.setCoordShift(**entered)
+        changed=self.plate.coordShiftKey()!=old
+        if changed and self.plate.doCoordShift:
+            self.projector.draw(self.plate, self.getActiveSetup(),
+                                channel=self.channel)
+            self.settled=False
+
+    def settleCoordParams(self):
+        self.settle_job=None
+        if not self.settled:
+            self.show(channel=self.channel)
+
     def show(self, channel='all'):
-        self.canvas.clear()
-        self.proj_can.clear()
+        self.channel=channel
+        if self.regionify:
+            #The plate is changing, regionsMade redraws with this channel
+            return
+        self.settled=True
+        #Update the items already on the canvas rather than redrawing them
+        self.canvas.beginFrame()
         self.info_str.set(self.plate.getSetupInfo(self.getActiveSetup()))
         self.plate.draw(self.canvas, channel=channel, active_setup=self.getActiveSetup())
-        self.plate.drawImage(self.proj_can, channel=channel,radmult=1.1, active_setup=self.getActiveSetup())
+        self.canvas.endFrame()
+        self.projector.draw(self.plate, self.getActiveSetup(), channel=channel)
 
 
     def makeRegions(self):
-        self.plate.regionify(setup_number=self.setup_str.get(),
-                             awith=self.get_assign_with_list())
-        self.show()
+        if self.regionify or self.loading:
+            return
+        for b in self.plate_buttons:
+            b.config(state=Tkinter.DISABLED)
+        self.regionify=RegionifyTask(self, self.plate, self.setup_str.get(),
+                                     self.get_assign_with_list(),
+                                     self.regionsMade)
+
+    def regionsMade(self, error):
+        self.regionify=None
+        for b in self.plate_buttons:
+            b.config(state=Tkinter.NORMAL)
+        if error:
+            tkMessageBox.showerror('Regionify', error)
+        #Apply coordinate parameters entered while it ran, then redraw
+        self.applyCoordParams()
+        self.show(channel=self.channel)
+
+    def reloadDeadFibers(self):
+        old_version, old_dead=deadfibers.registry()
+        version, dead=deadfibers.reload()
+        if version==old_version and not (dead==old_dead).all():
+            tkMessageBox.showwarning('Dead Fibers',
+                                     'The dead fibers changed but the version '
+                                     'is still {}, please increment it in '
+                                     '{}'.format(version,
+                                                 deadfibers.STATE_FILE))
+        if not self.plate.setups:
+            return
+        redone, conflicts=self.plate.revalidateDeadFibers()
+        if conflicts:
+            tkMessageBox.showwarning('Dead Fibers',
+                                     'Preset fibers are now dead, not '
+                                     'reassigned:\n'+
+                                     '\n'.join('{}: {} {}'.format(s, h['FIBER'],
+                                                                 h['ID'])
+                                               for s, h in conflicts))
+        if redone:
+            tkMessageBox.showinfo('Dead Fibers', 'Reassigned '+', '.join(redone))
+        if redone or conflicts:
+            self.show()
 
     def genPlate(self):
         self.plate.plateHoleInfo.write_platefile()
@@ -382,12 +860,34 @@ class App(Tkinter.Tk):
         file=askopenfilename(initialdir=dir,
                              filetypes=[('asc files', '.asc'),
                              ('plate files', '.plate')])
-        file=os.path.normpath(file)
-        print file
-        if file:
-            self.plate.load(file)
-            self.file_str.set(os.path.basename(file))
-            self.show()
+        if not file:
+            return
+        self.loadFile(os.path.normpath(file))
+
+    def browse(self):
+        dir=App.getPath(('hole_mapper','plates'))
+        PlateBrowser(self, dir, self.loadFile)
+
+    def loadFile(self, file):
+        if self.regionify:
+            return
+        #The current plate stays up until the new one is loaded
+        if self.loading:
+            self.loading.superseded=True
+        else:
+            self.loaded_str=self.file_str.get()
+        self.loading=PlateLoadTask(self, file, self.file_str, self.plateLoaded)
+
+    def plateLoaded(self, task, plate, error):
+        self.loading=None
+        if error:
+            self.file_str.set(self.loaded_str)
+            tkMessageBox.showerror('Load Holes', error)
+            return
+        plate.copyCoordShift(self.plate)
+        self.plate=plate
+        self.file_str.set(os.path.basename(task.file))
+        self.show()
         
     def makeImage(self,channel='all'):
         #The image canvas for drawing the plate to a file
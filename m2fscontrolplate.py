@@ -53,22 +53,38 @@ class Setup(object):
     It has the attributes:
     name
     """
-    def __init__(self, setupAttributes, targetDictList, guideDictList):
+    def __init__(self, setupAttributes, plateConfig, section):
         """
         setupAttributes must have name
-        Target list:[header_record_str, (fiber_str_i, target_record_i), ...]
+        plateConfig is the PlateConfigParser the setup came from and section
+        the name of the setup's section in it (e.g. Setup1). Target and guide
+        records are not parsed until first accessed.
         """
         self.name=setupAttributes['name']
         self.attrib=setupAttributes.copy()
-        self._target_list=targetDictList
-        self._guide_list=guideDictList
-        self.attrib['n']=self.n_fibers_used()
+        self._plateConfig=plateConfig
+        self._section=section
+        self._targets=None
+        self._guides=None
+        self.attrib['n']=plateConfig.n_targets_used(section)
+    
+    @property
+    def _target_list(self):
+        if self._targets is None:
+            self._targets=self._plateConfig.get_targets(self._section)
+        return self._targets
+
+    @property
+    def _guide_list(self):
+        if self._guides is None:
+            self._guides=self._plateConfig.get_guides(self._section)
+        return self._guides
     
     def get_nominal_fiber_hole_dict(self):
         return {t['fiber']:t['id'] for t in self._target_list if t['id']}
 
     def n_fibers_used(self):
-        return len([t for t in self._target_list if t['id']])
+        return self.attrib['n']
 
 
 class NullSetup(object):
@@ -180,6 +196,19 @@ class PlateConfigParser(ConfigParser.RawConfigParser):
                 ret.append(tdict)
         return ret
     
+    def n_targets_used(self, setup_section):
+        """
+        Return number of target records with an id for setup section, without
+        building the target dictionaries
+        """
+        recs=self.items(setup_section+':Targets')
+        
+        keys=map(str.lower, _extract_tab_quote_list(recs.pop(0)[1]))
+        ndx=keys.index('id')
+        
+        return len([1 for _, rec in recs
+                    if rec.split('\t')[ndx][1:-1]])
+    
     def get_guides(self, setup_section):
         """Return list of target dictionaries for setup section"""
         if self.file_version() == '0.1':
@@ -343,12 +372,11 @@ class PlugPlate(object):
             self.standard={}
             self.standard_offset=float('nan')
         
+        #Targets & guides are parsed by the setup on first access
         self.setups={}
         for setup in plateConfig.setup_sections():
             attrib=plateConfig.setup_dict(setup)
-            targets=plateConfig.get_targets(setup)
-            guides=plateConfig.get_guides(setup)
-            self.setups[attrib['name']]=Setup(attrib, targets, guides)
+            self.setups[attrib['name']]=Setup(attrib, plateConfig, setup)
     
     def getSetup(self, setup):
         """
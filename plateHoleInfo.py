@@ -2,9 +2,13 @@ from platefile import resfile, ascfile
 from Hole import Hole
 import Cassette
 import Setup
+import fiberprofile
+import deadfibers
 import os.path
 import math
+import numpy as np
 from m2fs.plate.plate import PlateConfigParser
+from m2fscontrolplate import Plate
 
 SCALE=14.25
 SH_RADIUS=0.1875
@@ -14,6 +18,11 @@ ORDERED_FIBER_NAMES=['{}{}-{:02}'.format(color,cnum,fnum)
                      for fnum in range(1,17)]
 
 
+class InfeasibleSetup(Exception):
+    """ Raised if a hole can't be assigned to any cassette """
+    pass
+
+
 class platefile(object):
     def __init__(self, filename):
         self.filename=filename
@@ -93,8 +102,12 @@ class plateHoleInfo(object):
     Frontend to the .res & .asc files of a setup
     used to retrieve information about a given hole
     """
-    def __init__(self,file):
-        
+    def __init__(self,file, progress=None):
+        """
+        progress, if given, is called as progress(setups_done, n_setups,
+        n_holes) as each setup is parsed
+        """
+        self._progress=progress
         self.setups={}
         self.cassettes={}
         self.cassette_groups={}
@@ -123,66 +136,16 @@ class plateHoleInfo(object):
             if 'Kounkel_2' in self.name:
                 _postProcessKounkel2Setups(self)
 
-            #set of cassettes with same color & slit in future this
-            # will come from plate file
+            #Fiber masks (usable fibers of each cassette) & sets of cassettes
+            # with same color & slit come from the fiber profiles, in future
+            # this will come from plate file
             #h & l are used to divide the physical cassettes into a high-numbered
             #fiber logical cassette and a low-numbered liber logical cassette
             #for a given cassette h & l had better be created with the same slit
             # assignemnts!
-            self.cassettes={s:Cassette.new_cassette_dict() for s in self.setups}
-            self.cassette_groups={s:[Cassette.blue_cassette_names(),
-                                     Cassette.red_cassette_names()]
-                                  for s in self.setups}
-        
-            if 'Carnegie_1' in self.name:
-                _postProcessIanCassettes(self)
-
-            if 'HotJupiters_1' in self.name:
-                _postProcessHJCassettes(self)
-
-#            if 'Calvet' in self.name:
-#                _postProcessCalvetCassettes(self)
-
-            if 'Outer_LMC_1' in self.name:
-                _postProcessNideverCassettes(self)
-    
-            if 'Vasily' in self.name:
-                _postProcessVasilyCassettes(self)
-                
-            if 'Kounkel_2' in self.name:
-                _postProcessKounkel2Cassettes(self)
-
-            if 'Calvet' in self.name:
-#                this doesn't work because hole.reset() copiest over the restriction to 'ASSIGNMENT' and the isAssigned() test just assumes the cassette is assigned if it is a string.'
-#                for h in self.setups['Setup 1']['holes']:
-#                    h['INIT_ASSIGNMENT']['CASSETTE']='R'
-#                for h in self.setups['Setup 2']['holes']:
-#                    h['INIT_ASSIGNMENT']['CASSETTE']='B'
-                _OddsOnly(self, 'Setup 1')
-                _OddsOnly(self, 'Setup 2')
-                _OddsOnly(self, 'Setup 3')
-                _OddsOnly(self, 'Setup 4')
-                _OddsOnly(self, 'Setup 5')
-                _OddsOnly(self, 'Setup 6')
-                _OddsOnly(self, 'Setup 7')
-                _OddsOnly(self, 'Setup 8')
-                
-                _ROnly(self, 'Setup 1')
-                _BOnly(self, 'Setup 2')
-                
-                _ROnly(self, 'Setup 3')
-                _BOnly(self, 'Setup 4')
-                
-                _ROnly(self, 'Setup 5')
-                _BOnly(self, 'Setup 6')
-                
-                _ROnly(self, 'Setup 8')
-
-            if 'Aarnio' in self.name:
-                _OddsOnly(self, 'Setup 1')
-                _OddsOnly(self, 'Setup 2')
-
-            _SetDeadFibers(self)
+            self._init_fiber_masks()
+            self.cassettes={s:Cassette.new_cassette_dict(mask=self.fiber_masks[s])
+                            for s in self.setups}
             
             for s in self.setups:
                 self.setups[s]['cassetteConfig']=self.cassettes_for_setup(s)
@@ -192,6 +155,68 @@ class plateHoleInfo(object):
             self._init_from_plate(file)
 
 
+    def _init_fiber_masks(self, profile=True):
+        """
+        Set the fiber mask of each setup, and if profile its cassette groups,
+        from the fiber profiles with the dead fibers removed. The masks of all
+        the setups are views into a single array.
+        """
+        setup_names=sorted(self.setups)
+        if profile:
+            masks, self.cassette_groups=fiberprofile.setup_masks(self.name,
+                                                                 setup_names)
+        else:
+            masks=np.empty((len(setup_names), len(Cassette.CASSETTE_NAMES),
+                            Cassette.N_FIBERS), dtype=bool)
+            masks[:]=Cassette.default_fiber_mask()
+        self._profile_fiber_masks=masks.copy()
+        self._dead_fiber_version, dead=deadfibers.registry()
+        self._dead_fiber_mask=dead
+        masks&=~dead
+        self._fiber_masks=masks
+        self.fiber_masks={s:masks[i] for i,s in enumerate(setup_names)}
+
+    def revalidate_dead_fibers(self):
+        """
+        Apply the current dead fiber registry to the setup fiber masks if its
+        version or dead fibers have changed since they were created. Returns
+        the names of the setups with fibers assigned which are now dead.
+        """
+        version, dead=deadfibers.registry()
+        if (version==self._dead_fiber_version and
+            np.array_equal(dead, self._dead_fiber_mask)):
+            return []
+        self._fiber_masks[:]=self._profile_fiber_masks & ~dead
+        self._dead_fiber_version=version
+        self._dead_fiber_mask=dead
+        
+        affected=[]
+        for name, setup in self.setups.iteritems():
+            for c in setup.get('cassetteConfig',{}).itervalues():
+                row=Cassette.CASSETTE_INDEX[c.name]
+                if any(dead[row, fnum-1] for fnum in c.map):
+                    affected.append(name)
+                    break
+        return affected
+
+    def dead_preset_holes(self, setup_name):
+        """
+        Return the holes of setup_name with a preset fiber which its fiber
+        mask does not allow
+        """
+        mask=self.fiber_masks[setup_name]
+        ret=[]
+        for h in self.setups[setup_name]['holes']:
+            if h['USER_ASSIGNED']:
+                row=Cassette.CASSETTE_INDEX[Cassette.fiber2cassettename(h['FIBER'])]
+                if not mask[row, int(h['FIBER'].split('-')[1])-1]:
+                    ret.append(h)
+        return ret
+
+    def _report_progress(self, done, total):
+        if self._progress is not None:
+            self._progress(done, total, len(self.holeSet))
+
     def _init_fromASC(self):
         #add shack hartman holes
         
@@ -227,7 +252,10 @@ class plateHoleInfo(object):
             self.holeSet.add(h)
         
         #Go through all the setups in the files
-        for setup_name, setup_dict in self.rfile.setups.items():
+        n_setups=len(self.rfile.setups)
+        for n_done, (setup_name, setup_dict) in enumerate(
+                                                self.rfile.setups.items()):
+            self._report_progress(n_done, n_setups)
             
             #make sure setup is in both
             if setup_name not in self.afile.setups.keys():
@@ -278,9 +306,12 @@ class plateHoleInfo(object):
                      idstr=aline,
                      **addit)
 
-                #Enforce holes exist only once
+                #Enforce holes exist only once, the fiducial & thumbscrew
+                # holes are read from the setup lines as well as
+                # fid_thumb_lines so are expected to be there already
                 if hole in self.holeSet:
-                    print "Duplicate hole: {}".format(hole)
+                    if atype not in ('F', 'T'):
+                        print "Duplicate hole: {}".format(hole)
                     for h in self.holeSet:
                         if h.hash==hole.hash:
                             hole=h
@@ -314,6 +345,7 @@ class plateHoleInfo(object):
                             self.setups[setup_name]['INFO']['DE']),
                             (std_ra,std_de))
             self.setups[setup_name]['INFO']['NAME']=setup_name
+        self._report_progress(n_setups, n_setups)
 
     def _init_from_plate(self, file):
     
@@ -347,7 +379,9 @@ class plateHoleInfo(object):
         self.holeSet.update(self.mechanical_holes)
     
         #Go through all the setups in the files
-        for setup_name, setup in plate.setups.iteritems():
+        n_setups=len(plate.setups)
+        for n_done, (setup_name, setup) in enumerate(plate.setups.iteritems()):
+            self._report_progress(n_done, n_setups)
             
             targets=[]
             other=[]
@@ -396,33 +430,38 @@ class plateHoleInfo(object):
                 self.setups[setup_name]['holes']=targets
                 self.setups[setup_name]['INFO']=setup.attrib.copy()
 
-                self.cassettes[setup_name]=Cassette.new_cassette_dict()
-                for h in targets:
-                    if h['FIBER']:
-                        cname=h['ASSIGNMENT']['CASSETTE']
-                        fnum=h['ASSIGNMENT']['FIBERNO']
-                        self.cassettes[setup_name][cname].map[fnum]=h
-                        self.cassettes[setup_name][cname].holes.append(h)
-                        self.cassettes[setup_name][cname].used+=1
-                
-                self.setups[setup_name]['cassetteConfig']=self.cassettes[setup_name]
                 self.cassette_groups[setup_name]=[Cassette.blue_cassette_names(),
                                                   Cassette.red_cassette_names()]
 
+        self._report_progress(n_setups, n_setups)
+        self._init_fiber_masks(profile=False)
+        
+        for setup_name, setup in self.setups.iteritems():
+            cassettes=Cassette.new_cassette_dict(mask=self.fiber_masks[setup_name])
+            for h in setup['holes']:
+                if h['FIBER']:
+                    cname=h['ASSIGNMENT']['CASSETTE']
+                    fnum=h['ASSIGNMENT']['FIBERNO']
+                    cassettes[cname].map[fnum]=h
+                    cassettes[cname].holes.append(h)
+                    cassettes[cname].used+=1
+            self.cassettes[setup_name]=cassettes
+            setup['cassetteConfig']=cassettes
+
         self.plate=plate
 
     def cassettes_for_setup(self,setup_name):
         import copy
         ret=copy.deepcopy(self.cassettes[setup_name])
         if not ret:
-            import ipd;ipd.set_trace()
+            raise InfeasibleSetup('No cassettes for {}'.format(setup_name))
         return ret
     
     def cassette_groups_for_setup(self, setup_name):
         return self.cassette_groups[setup_name]
 
-    def write_platefile(self):
-        
+    def write_platefile(self, file=None):
+        """Write the .plate file, to file if given else pfile_filename"""
         
         plate_holes=[]
         for h in self.mechanical_holes+[self.sh_hole,self.standard['hole']]:
@@ -502,7 +541,8 @@ class plateHoleInfo(object):
                                 'Guide':guide_holes,
                                 'Unused':[]} #TODO in the future
 
-        pfile=PlateConfigParser( self.pfile_filename,sections=pfile_data)
+        pfile=PlateConfigParser(file or self.pfile_filename,
+                                sections=pfile_data)
         pfile.write()
 
 def _postProcessHJSetups(plateinfo):
@@ -607,229 +647,6 @@ def _postProcessKounkel2Setups(plateinfo):
     h.sort(key=lambda h: h['PRIORITY'],reverse=True)
     plateinfo.setups['Setup 2']['holes']=h[0:128]
 
-def _postProcessIanCassettes(plateinfo):
-    """
-    Take the 2 setups for Nov13 Bailey plate and break them into the
-    6 real setups
-    """
-    for c in  plateinfo.cassettes['Setup 2'].values():
-        if 'l' in c.name:
-            if 'R8' in c.name:
-                c.usable=[1]
-            else:
-                c.usable=[1,8]
-        else:
-            if 'R8' in c.name:
-                c.usable=[9,16]
-            else:
-                c.usable=[15]
-
-def _postProcessHJCassettes(plateinfo):
-    for s in ['Setup 3','Setup 6']:
-        for c in  plateinfo.cassettes[s].values():
-            if 'l' in c.name:
-                c.usable=[2,4,6,8]
-            else:
-                c.usable=[10,12,14,16]
-    for c in  plateinfo.cassettes['Setup 4'].values():
-        if 'l' in c.name:
-            c.usable=[2]
-        else:
-            c.usable=[16]
-    for c in  plateinfo.cassettes['Setup 1'].values():
-        #have 8 want in fiber 8 of every other tetris
-        if c.name[1] in ['1','3','5','7']:
-            if 'l' in c.name:
-                c.usable=[8]
-            else:
-                c.usable=[]
-        else:
-            c.usable=[]
-    for s in ['Setup 2','Setup 5']:
-        for c in  plateinfo.cassettes[s].values():
-            if 'l' in c.name:
-                c.usable=range(1,8,2)
-            else:
-                c.usable=range(9,16,2)
-
-def _postProcessCalvetCassettes(plateinfo):
-    for c_set in plateinfo.cassettes.values():
-        for c in c_set.values():
-            if 'l' in c.name:
-                c.usable=[2,4,6,8]
-            else:
-                c.usable=[10,12,14,16]
-
-def _postProcessVasilyCassettes(plateinfo):
-    #Setups 1, 2, 3, 4
-    ok=['B1','R1','B5','R5','B2','R2','B6','R6']
-    for c in  plateinfo.cassettes['Setup 1'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 1']=[[i+k for i in ok for k in 'lh']]
-    
-    ok=['B3','R3','B7','R7','B4','R4','B8','R8']
-    for c in  plateinfo.cassettes['Setup 2'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 2']=[[i+k for i in ok for k in 'lh']]
-
-def _postProcessKounkel2Cassettes(plateinfo):
-    cnames=Cassette.new_cassette_dict().keys()
-
-    ok3=['B1h','R3h','B5h','R7h']
-    ok5=['R2l','R6h','R6l']
-    filtered_left=[c for c in Cassette.left_only(cnames) if c not in ok5]
-    filtered_right=[c for c in Cassette.right_only(cnames) if c not in ok3]
-    ok3+=filtered_left
-    ok5+=filtered_right
-    #Setups 3
-    ok=ok3
-    for c in  plateinfo.cassettes['Setup 3'].values():
-        if c.name in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 3']=[ok]
-    #Setup 5
-    ok=ok5
-    for c in  plateinfo.cassettes['Setup 5'].values():
-        if c.name in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 5']=[ok]
-    #Setup 1
-    ok=['R'+str(i)+lh for i in range(1,9) for lh in 'lh']
-    for c in  plateinfo.cassettes['Setup 1'].values():
-        if c.name in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 1']=[ok]
-    #Setup 1
-    ok=['B'+str(i)+lh for i in range(1,9) for lh in 'lh']
-    for c in  plateinfo.cassettes['Setup 2'].values():
-        if c.name in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 2']=[ok]
-
-
-def _postProcessNideverCassettes(plateinfo):
-    #Setups 1, 2, 3, 4
-    ok=['B1','B5','B2','B6']
-    for c in  plateinfo.cassettes['Setup 1'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 1']=[[i+k for i in ok for k in 'lh']]
-
-    ok=['R1','R5','R2','R6']
-    for c in  plateinfo.cassettes['Setup 2'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 2']=[[i+k for i in ok for k in 'lh']]
-
-    ok=['B3','B7','B4','B8']
-    for c in  plateinfo.cassettes['Setup 3'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 3']=[[i+k for i in ok for k in 'lh']]
-
-    ok=['R3','R7','R4','R8']
-    for c in  plateinfo.cassettes['Setup 4'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 4']=[[i+k for i in ok for k in 'lh']]
-
-    #Setups 5, 6, 7, 8
-    ok=['B1','B5','B2','B6']
-    for c in  plateinfo.cassettes['Setup 5'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 5']=[[i+k for i in ok for k in 'lh']]
-
-    ok=['R1','R5','R2','R6']
-    for c in  plateinfo.cassettes['Setup 6'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 6']=[[i+k for i in ok for k in 'lh']]
-
-    ok=['B3','B7','B4','B8']
-    for c in  plateinfo.cassettes['Setup 7'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 7']=[[i+k for i in ok for k in 'lh']]
-
-    ok=['R3','R7','R4','R8']
-    for c in  plateinfo.cassettes['Setup 8'].values():
-        if c.name[0:2] in ok:
-            if 'l' in c.name:
-                c.usable=range(1,9)
-            else:
-                c.usable=range(9,17)
-        else:
-            c.usable=[]
-    plateinfo.cassette_groups['Setup 8']=[[i+k for i in ok for k in 'lh']]
-
 def parse_extra_data(name,setup, words):
     if name=='Calvet_sum':
         if words[0].lower()=='f':
@@ -906,43 +723,3 @@ def parse_extra_data(name,setup, words):
         ret['MAGNITUDE']=nanfloat(l[2])
 
     return ret
-
-def _OddsOnly(plateinfo, setup):
-    for c in plateinfo.cassettes[setup].itervalues():
-        if 'l' in c.name:
-            c.usable=[1,3,5,7]
-        else:
-            c.usable=[9,11,13,15]
-
-def _ROnly(plateinfo, setup):
-    for c in plateinfo.cassettes[setup].itervalues():
-        if 'B' in c.name:
-            c.usable=[]
-    plateinfo.cassette_groups[setup]=[Cassette.red_cassette_names()]
-
-def _BOnly(plateinfo, setup):
-    for c in  plateinfo.cassettes[setup].itervalues():
-        if 'R' in c.name:
-            c.usable=[]
-    plateinfo.cassette_groups[setup]=[Cassette.blue_cassette_names()]
-
-def _SetDeadFibers(plateinfo):
-    dead=( ('R1l',(2,)),
-           ('R8h',(9,)),
-           ('R2h',(9,)),
-           ('R7h',(11, 12)),
-           ('B4l',(5,)),
-           ('B4h',(15,)),
-           ('B6l',(2,4)))
-#           b8-3, 6-13,5-7,4-4 treat as ok
-#           r8-3, 8-8, treat as ok
-
-    for cassettes in plateinfo.cassettes.itervalues():
-        for cname, fnums in dead:
-            for fnum in fnums:
-                try:
-                    cassettes[cname].usable.remove(fnum)
-                except Exception:
-                    pass
-
-
@@ -0,0 +1,165 @@
+'''
+Persistent index of plate file summaries
+
+Keeps the plate and setup attributes needed by summarize.py and the GUI plate
+browser in a small sqlite database so that only new or changed .plate files
+need to be parsed.
+'''
+import os.path
+import sqlite3
+
+SETUP_KEYS=['name', 'ra', 'de', 'epoch', 'sidereal_time', 'airmass', 'n']
+
+_SCHEMA=('CREATE TABLE IF NOT EXISTS plates ('
+         'file TEXT PRIMARY KEY, mtime REAL, name TEXT, n_setups INTEGER, '
+         'error TEXT)',
+         'CREATE TABLE IF NOT EXISTS setups ('
+         'file TEXT, ord INTEGER, '+', '.join(k+' TEXT' for k in SETUP_KEYS)+
+         ', PRIMARY KEY (file, ord))')
+
+
+class PlateIndex(object):
+    """
+    An on-disk index of plate summaries keyed by plate file path.
+
+    Summaries are dicts with 'name', 'n_setups', & 'setups', a list of setup
+    attribute dicts with the keys in SETUP_KEYS, i.e. the same records
+    produced by summarize.read_plate_summary. A file is reparsed only if its
+    modification time differs from the one recorded in the index. Files
+    which failed to parse are recorded with their error so they are not
+    retried until they change.
+    """
+    def __init__(self, dbfile):
+        self.dbfile=dbfile
+        self._db=sqlite3.connect(dbfile)
+        self._db.text_factory=str
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def stale(self, platefiles):
+        """Return the platefiles that are missing from or outdated in the index"""
+        cur=self._db.cursor()
+        ret=[]
+        for f in platefiles:
+            mtime=_mtime(f)
+            if mtime is None:
+                #Deleted since it was listed, treat it as pruned
+                self._forget(f)
+                continue
+            cur.execute('SELECT mtime FROM plates WHERE file=?', (_key(f),))
+            row=cur.fetchone()
+            if row is None or row[0]!=mtime:
+                ret.append(f)
+        return ret
+
+    def update(self, platefiles, workers=1):
+        """
+        Parse any new or changed platefiles into the index, using workers
+        processes, and drop the files from the index which no longer exist.
+        Returns the list of files that were parsed.
+        """
+        from summarize import read_plate_summary
+        self.prune()
+        stale=self.stale(platefiles)
+        if not stale:
+            return stale
+        #Taken before parsing so a file changed while it is parsed stays stale
+        mtimes=[_mtime(f) for f in stale]
+        if workers > 1 and len(stale) > 1:
+            import multiprocessing
+            pool=multiprocessing.Pool(workers)
+            try:
+                results=pool.map(read_plate_summary, stale)
+            finally:
+                pool.terminate()
+        else:
+            results=map(read_plate_summary, stale)
+        for f, mtime, (summary, err) in zip(stale, mtimes, results):
+            if mtime is None or not os.path.exists(f):
+                self._forget(f)
+            else:
+                self._store(f, mtime, summary, err)
+        self._db.commit()
+        return stale
+
+    def prune(self):
+        """Remove the files which no longer exist from the index"""
+        cur=self._db.cursor()
+        cur.execute('SELECT file FROM plates')
+        for f, in cur.fetchall():
+            if not os.path.exists(f):
+                self._forget(f)
+        self._db.commit()
+
+    def _forget(self, file):
+        key=_key(file)
+        self._db.execute('DELETE FROM setups WHERE file=?', (key,))
+        self._db.execute('DELETE FROM plates WHERE file=?', (key,))
+
+    def _store(self, file, mtime, summary, error):
+        key=_key(file)
+        self._db.execute('DELETE FROM setups WHERE file=?', (key,))
+        if summary:
+            self._db.execute('INSERT OR REPLACE INTO plates VALUES (?,?,?,?,?)',
+                             (key, mtime, summary['name'],
+                              summary['n_setups'], None))
+            for i, attrib in enumerate(summary['setups']):
+                self._db.execute('INSERT INTO setups VALUES (?,?'+
+                                 ',?'*len(SETUP_KEYS)+')',
+                                 [key, i]+[str(attrib.get(k, ''))
+                                           for k in SETUP_KEYS])
+        else:
+            self._db.execute('INSERT OR REPLACE INTO plates VALUES (?,?,?,?,?)',
+                             (key, mtime, None, None, error))
+
+    def lookup(self, file):
+        """
+        Return (summary, error) for an indexed file or (None, None) if it is
+        not in the index. The index is not updated.
+        """
+        key=_key(file)
+        cur=self._db.cursor()
+        cur.execute('SELECT name, n_setups, error FROM plates WHERE file=?',
+                    (key,))
+        row=cur.fetchone()
+        if row is None:
+            return None, None
+        name, n_setups, error=row
+        if error is not None:
+            return None, error
+        cur.execute('SELECT '+', '.join(SETUP_KEYS)+' FROM setups '
+                    'WHERE file=? ORDER BY ord', (key,))
+        setups=[dict(zip(SETUP_KEYS, r)) for r in cur.fetchall()]
+        return {'name':name, 'n_setups':n_setups, 'setups':setups}, None
+
+    def summaries(self, platefiles, workers=1):
+        """
+        Bring the index up to date for platefiles and return a list of
+        (summary, error) in the order of platefiles. Files which no longer
+        exist are reported as errors.
+        """
+        platefiles=list(platefiles)
+        self.update(platefiles, workers=workers)
+        ret=[]
+        for f in platefiles:
+            summary, err=self.lookup(f)
+            if summary is None and err is None:
+                err='No such file: {}'.format(f)
+            ret.append((summary, err))
+        return ret
+
+
+def _key(file):
+    return os.path.abspath(file)
+
+
+def _mtime(file):
+    """Return the modification time of file or None if it does not exist"""
+    try:
+        return os.path.getmtime(file)
+    except OSError:
+        return None
@@ -1,7 +1,10 @@
 #! /usr/bin/env python
 import glob
-import sys
-from m2fscontrolPlate import Plate
+import itertools
+import argparse
+import multiprocessing
+from m2fscontrolplate import Plate
+from plateindex import PlateIndex
 
 def target(name, ra, de, ep=2000.0):
     return {'name':name,'ra':ra,'de':de,'epoch':ep}
@@ -10,32 +13,85 @@ extra=[target('HD223311','23 49 14.1','-06 18 20'),
        target('HIP48331','09 51 06.68','-43 30 05.9'),
        target('HIP10798','02 18 58.65','-25 56 48.4')]
 
-def write_summary_file(sfile, platefiles):
-    tlist=[]
+def read_plate_summary(file):
+    """
+    Parse a plate file and return a tuple of (summary, error). The summary is
+    a dict with the plate 'name', 'n_setups' & a list of setup attribute
+    dicts under 'setups'. On failure summary is None and error the message
+    that should be reported for the file.
+    """
+    try:
+        p=Plate(file)
+        if p.file_version=='0.1':
+            raise Exception("Can't process v0.1"+file)
+    except Exception, e:
+        return None, 'Platefile Error: {}'.format(e)
+    summary={'name':p.name, 'n_setups':p.n_setups,
+             'setups':[setup.attrib for setup in p.setups.itervalues()]}
+    return summary, None
+
+def read_plate_summaries(platefiles, workers=1):
+    """
+    Generate plate summaries for platefiles in order, reporting bad files
+    as they are reached. With workers > 1 the files are parsed by a pool of
+    worker processes.
+    """
+    if workers > 1:
+        pool=multiprocessing.Pool(workers)
+        results=pool.imap(read_plate_summary, platefiles)
+    else:
+        pool=None
+        results=itertools.imap(read_plate_summary, platefiles)
+    try:
+        for summary in _report_errors(results):
+            yield summary
+    finally:
+        if pool:
+            pool.terminate()
+
+def _report_errors(results):
+    """Print the errors in an iterable of (summary, error) yielding summaries"""
+    for summary, err in results:
+        if err:
+            print err
+            continue
+        yield summary
+
+def write_summary_file(sfile, platefiles, workers=1, index=None):
+    """
+    Write the summary of platefiles to sfile and return the list of setup
+    target records. If index, a plateindex.PlateIndex, is given only plates
+    which are new or changed since they were indexed are parsed.
+    """
+    return list(iter_summary_records(sfile, platefiles, workers=workers,
+                                     index=index))
+
+def iter_summary_records(sfile, platefiles, workers=1, index=None):
+    """
+    Generate the setup target records of platefiles while writing their
+    summary to sfile as in write_summary_file, each plate is written as it
+    is read. The summary is only complete once the records are exhausted.
+    """
     platerec='{name:<10} {ns:<2}\n'
     setuprec=('     {name:<11} {ra:<12} {de:<12} '
              '{epoch:<11} {sidereal_time:<11} {airmass:<11} {n:<11}\n')
+    if index:
+        plates=_report_errors(index.summaries(platefiles, workers=workers))
+    else:
+        plates=read_plate_summaries(platefiles, workers=workers)
     with open(sfile,'w') as fp:
-        for f in platefiles:
-            try:
-                p=Plate(f)
-                if p.file_version=='0.1':
-                    raise Exception("Can't process v0.1"+f)
-            except Exception, e:
-                print 'Platefile Error: {}'.format(e)
-                continue
+        for p in plates:
 
-            fp.write(platerec.format(name=p.name, ns=p.n_setups))
+            fp.write(platerec.format(name=p['name'], ns=p['n_setups']))
 
             fp.write(setuprec.format(name='Name', ra='RA',
                 de='DE',epoch='Epoch', sidereal_time='ST',
                 airmass='Air', n='N'))
-            for sname, setup in p.setups.iteritems():
-                fp.write(setuprec.format(**setup.attrib))
-                attrib=setup.attrib.copy()
-                attrib['name']=p.name+' '+attrib['name']
-                tlist.append(attrib)
-    return tlist
+            for sattrib in p['setups']:
+                fp.write(setuprec.format(**sattrib))
+                attrib=sattrib.copy()
+                attrib['name']=p['name']+' '+attrib['name']
+                yield attrib
 
 def write_target_list(tfile, recs):
     """rec iterable of dicts with 'name' 'ra', 'de', & 'epoch'"""
@@ -106,10 +162,27 @@ def sexiegesmal_fmt(n, ra=False):
 
 if __name__ == '__main__':
 
-    fname=sys.argv[1]
+    parser=argparse.ArgumentParser(description='Summarize the plates in the '
+                                   'current directory')
+    parser.add_argument('name', help='Prefix for the _summ.txt and _tlist.txt '
+                        'output files')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Number of worker processes used to parse plates')
+    parser.add_argument('--index', default=None,
+                        help='Plate index database, only new or changed '
+                        'plates are parsed when given')
+    args=parser.parse_args()
+
+    fname=args.name
     sfile=fname+'_summ.txt'
     tfile=fname+'_tlist.txt'
-    files = glob.glob('*.plate')
+    files = glob.iglob('*.plate')
+    
+    if args.index:
+        index=PlateIndex(args.index)
+    else:
+        index=None
     
-    trec=write_summary_file(sfile, files)
-    write_target_list(tfile, trec+extra)
+    #The summary and target list are written together as each plate is read
+    trec=iter_summary_records(sfile, files, workers=args.workers, index=index)
+    write_target_list(tfile, itertools.chain(trec, extra))
@@ -0,0 +1,268 @@
+#! /usr/bin/env python
+'''
+Generate synthetic plates for testing and benchmarking
+
+For a plate name, writes the files the plate design software makes,
+<name>_Sum.asc and <name>_plate.res, and <name>_assigned.plate, a plate file
+with fibers assigned to the same holes. The number of setups and targets, the
+fraction of targets that are sky, the slit widths used and the fraction of
+targets plugged in the .plate file are configurable. A dead fiber state file,
+<name>_dead_fibers.cfg, is written too if dead fibers are asked for, no
+fibers in it are assigned in the .plate file.
+
+Every target in a .plate file is assigned by the user, so loading one gives a
+plate with all its fibers preset; the .asc/.res files leave all the fibers to
+be assigned.
+'''
+import argparse
+import math
+import os.path
+import random
+import Cassette
+
+SCALE=14.25 #also change in plateHoleInfo.py
+#Radii in .asc units of the area targets are placed in and of the fiducial
+# and thumbscrew holes
+TARGET_RADIUS=12.5
+MECHANICAL_RADIUS=13.5
+FIBER_HOLE_RADIUS=0.1735
+GUIDE_HOLE_RADIUS=0.2
+SH_HOLE_RADIUS=0.1875
+#Space left between holes, .asc units
+MIN_HOLE_GAP=0.05
+SLITS=(180, 125, 95, 75, 58, 45)
+FIBER_NAMES=['{}{}-{:02}'.format(color, cnum, fnum)
+             for color in 'RB'
+             for cnum in range(1,9)
+             for fnum in range(1,17)]
+
+class _Placer(object):
+    """Picks random hole positions not overlapping holes already placed"""
+    def __init__(self, rnd):
+        self.rnd=rnd
+        self.cell=2*GUIDE_HOLE_RADIUS+MIN_HOLE_GAP
+        self.grid={}
+
+    def _cell(self, x, y):
+        return int(math.floor(x/self.cell)), int(math.floor(y/self.cell))
+
+    def fits(self, x, y, r):
+        i,j=self._cell(x, y)
+        for di in (-1,0,1):
+            for dj in (-1,0,1):
+                for hx, hy, hr in self.grid.get((i+di, j+dj), ()):
+                    if math.hypot(hx-x, hy-y) < r+hr+MIN_HOLE_GAP:
+                        return False
+        return True
+
+    def add(self, x, y, r):
+        self.grid.setdefault(self._cell(x, y), []).append((x, y, r))
+
+    def place(self, r, radius=TARGET_RADIUS):
+        while True:
+            x=self.rnd.uniform(-radius, radius)
+            y=self.rnd.uniform(-radius, radius)
+            if math.hypot(x, y) <= radius and self.fits(x, y, r):
+                self.add(x, y, r)
+                return x, y
+
+def _sexagesimal(value, hours=False):
+    """Format degrees as 'dd mm ss.s', or as 'hh mm ss.ss' if hours"""
+    if hours:
+        value/=15.0
+    sign='-' if value < 0 else ''
+    value=abs(value)
+    d=int(value)
+    m=int((value-d)*60)
+    s=(value-d-m/60.0)*3600
+    if hours:
+        return '{}{:02} {:02} {:05.2f}'.format(sign, d, m, s)
+    return '{}{:02} {:02} {:04.1f}'.format(sign, d, m, s)
+
+def generate(name, outdir='.', setups=2, targets=200, sky_fraction=0.15,
+             guides=2, acquisitions=3, slits=(180,), preset=1.0, dead=0,
+             seed=0):
+    """
+    Write the files of a synthetic plate name to outdir, see the module
+    documentation. Each setup has targets science and sky holes, sky_fraction
+    of them sky, and guides guide and acquisitions acquisition holes. Each
+    cassette of a setup in the .plate file uses a slit width picked from
+    slits. Returns the list of files written.
+    """
+    if targets > len(FIBER_NAMES)-dead:
+        raise ValueError('More targets than live fibers')
+    rnd=random.Random(seed)
+    placer=_Placer(rnd)
+
+    deadfibers=sorted(rnd.sample(FIBER_NAMES, dead))
+
+    #Holes shared by every setup
+    sh=(0.0, 0.0, 0.0, SH_HOLE_RADIUS, 'C', 'sh')
+    placer.add(0.0, 0.0, SH_HOLE_RADIUS)
+    x,y=placer.place(FIBER_HOLE_RADIUS)
+    standard=(x, y, 0.0, FIBER_HOLE_RADIUS, 'O', 'std')
+    mechanical=[]
+    for i, type in enumerate('FFFFTT'):
+        angle=2*math.pi*i/6+rnd.uniform(-0.2, 0.2)
+        x,y=MECHANICAL_RADIUS*math.cos(angle), MECHANICAL_RADIUS*math.sin(angle)
+        placer.add(x, y, GUIDE_HOLE_RADIUS)
+        mechanical.append((x, y, 0.0, GUIDE_HOLE_RADIUS, type, 'fid'))
+
+    field_ra=rnd.uniform(0, 360)
+    field_de=rnd.uniform(-80, 10)
+    plate_setups=[]
+    for s in range(1, setups+1):
+        holes=[]
+        for i in range(targets):
+            type='S' if rnd.random() < sky_fraction else 'O'
+            x,y=placer.place(FIBER_HOLE_RADIUS)
+            holes.append((x, y, 0.0, FIBER_HOLE_RADIUS, type))
+        for type, n in (('G', guides), ('A', acquisitions)):
+            for i in range(n):
+                x,y=placer.place(GUIDE_HOLE_RADIUS)
+                holes.append((x, y, 0.0, GUIDE_HOLE_RADIUS, type))
+        ra=field_ra+rnd.uniform(-0.1, 0.1)
+        de=field_de+rnd.uniform(-0.1, 0.1)
+        #Nominal fibers of the design software, cycling through the fibers
+        matt=['{}-{:02}-{:02}'.format('BR'[(i//16)%2], (i//32)%8+1, i%16+1)
+              if h[4] in 'OS' else 'X-00-00' for i,h in enumerate(holes)]
+        plate_setups.append({'name':'Setup {}'.format(s), 'holes':holes,
+                             'matt':matt, 'ra':ra, 'de':de,
+                             'utc':(0, 0, 0, 11, 11, 2013)})
+
+    def sky_coords(x, y, setup):
+        #Roughly 1 arcmin per .asc unit
+        return (_sexagesimal(setup['ra']-x/60.0, hours=True),
+                _sexagesimal(setup['de']+y/60.0))
+
+    files=[os.path.join(outdir, name+'_Sum.asc'),
+           os.path.join(outdir, name+'_plate.res'),
+           os.path.join(outdir, name+'_assigned.plate')]
+
+    with open(files[0], 'w') as asc, open(files[1], 'w') as res:
+        for setup in plate_setups:
+            asc.write('{} x x 01:00:00 02:00:00 x x 1.10 x x 70.0 '
+                      '120.0\n'.format(setup['name']))
+            res.write('{} 2000.0\nsynthetic\n{} {} {} {} {} {}\n'.format(
+                      ' '.join(sky_coords(0, 0, setup)), *setup['utc']))
+            lines=[]
+            #The standard, fiducial & thumbscrew holes are written once, in
+            # the first setup, where the .asc reader expects them
+            if setup is plate_setups[0]:
+                lines.append((standard[:5], 'R-01-17'))
+                lines.extend((h[:5], 'X-00-00') for h in mechanical)
+            lines.extend(zip(setup['holes'], setup['matt']))
+            for (x, y, z, r, type), fiber in lines:
+                asc.write('  {:.4f} {:.4f} {:.4f} {:.4f} {} {}\n'.format(
+                          x, y, z, r, type, fiber))
+                res.write('{} {} {} 2000.0 {}\n'.format(fiber,
+                          *sky_coords(x, y, setup)+(type,)))
+            res.write('END\n')
+
+    def record(values):
+        return '\t'.join('"{}"'.format(v) for v in values)
+
+    with open(files[2], 'w') as plate:
+        plate.write('[Plate]\nformatversion=0.2\nname={}_assigned\n'
+                    'std_offset=0.0\n\n'.format(name))
+        plate.write('[PlateHoles]\nH='+record(('x', 'y', 'z', 'r', 'type',
+                                               'id'))+'\n')
+        for i, h in enumerate([sh, standard]+mechanical):
+            plate.write('H{}='.format(i+1)+record(['{:.4f}'.format(v)
+                                                   for v in h[:4]]+
+                                                  list(h[4:]))+'\n')
+        for n, setup in enumerate(plate_setups):
+            section='Setup{}'.format(n+1)
+            ra, de=sky_coords(0, 0, setup)
+            plate.write('\n[{}]\nname={}\nutc=2013-11-11 00:00:00\n'
+                        'sidereal_time=01:00:00\nel=70\nde={}\nepoch=2000.0\n'
+                        'az=120\ntelescope=Clay\nairmass=1.1\nra={}\n'.format(
+                        section, setup['name'], de, ra))
+
+            #Plug the preset targets on the nearest live fibers, both halves
+            # of a cassette use the same slit
+            slit={c[:2]:rnd.choice(slits)
+                  for c in sorted(Cassette.cassette_positions)}
+            free={c:[f for f in FIBER_NAMES if f not in deadfibers and
+                     Cassette.fiber2cassettename(f)==c]
+                  for c in Cassette.cassette_positions}
+            plugged={}
+            science=[h for h in setup['holes'] if h[4] in 'OS']
+            for x, y, z, r, type in rnd.sample(science,
+                                               int(round(preset*len(science)))):
+                pos=(x/SCALE, y/SCALE)
+                c=min((c for c in free if free[c]),
+                      key=lambda c:math.hypot(
+                              pos[0]-Cassette.cassette_positions[c][0],
+                              pos[1]-Cassette.cassette_positions[c][1]))
+                plugged[free[c].pop(0)]=((x, y, z, r, type), slit[c[:2]])
+
+            plate.write('\n[{}:Targets]\nH='.format(section)+
+                        record(('ra', 'de', 'ep', 'x', 'y', 'z', 'r', 'type',
+                                'priority', 'id', 'slit'))+'\n')
+            for i, fiber in enumerate(FIBER_NAMES):
+                if fiber in plugged:
+                    (x, y, z, r, type), s=plugged[fiber]
+                    values=(sky_coords(x, y, setup)+('2000.0',)+
+                            tuple('{:.4f}'.format(v) for v in (x, y, z, r))+
+                            (type, '0', '{}{:03}'.format(type, i), s))
+                else:
+                    values=('',)*7+('U', '0', 'unassigned', '180')
+                plate.write(fiber+'='+record(values)+'\n')
+
+            plate.write('\n[{}:Guide]\nH='.format(section)+
+                        record(('ra', 'de', 'ep', 'x', 'y', 'z', 'r',
+                                'type'))+'\n')
+            for i, (x, y, z, r, type) in enumerate(h for h in setup['holes']
+                                                   if h[4] in 'GA'):
+                plate.write('G{}='.format(i+1)+record(sky_coords(x, y, setup)+
+                            ('2000.0',)+tuple('{:.4f}'.format(v)
+                                              for v in (x, y, z, r))+
+                            (type,))+'\n')
+
+    if dead:
+        files.append(os.path.join(outdir, name+'_dead_fibers.cfg'))
+        with open(files[-1], 'w') as cfg:
+            cfg.write('[State]\nversion=synthetic-{}\n\n[DeadFibers]\n'
+                      'fibers={}\n'.format(seed, ', '.join(deadfibers)))
+    return files
+
+
+if __name__ == '__main__':
+
+    parser=argparse.ArgumentParser(description='Write synthetic .asc/.res '
+                                   'and .plate files')
+    parser.add_argument('name', help='Plate name')
+    parser.add_argument('-o', '--outdir', default='.',
+                        help='Directory for the files')
+    parser.add_argument('--setups', type=int, default=2,
+                        help='Number of setups, default %(default)s')
+    parser.add_argument('--targets', type=int, default=200,
+                        help='Science and sky holes per setup, default '
+                        '%(default)s')
+    parser.add_argument('--sky', type=float, default=0.15,
+                        help='Fraction of targets that are sky, default '
+                        '%(default)s')
+    parser.add_argument('--slits', default='180',
+                        help='Comma separated slit widths for the cassettes '
+                        'of the .plate file, default %(default)s')
+    parser.add_argument('--preset', type=float, default=1.0,
+                        help='Fraction of targets plugged in the .plate file, '
+                        'default %(default)s')
+    parser.add_argument('--dead', type=int, default=0,
+                        help='Number of dead fibers, default %(default)s')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, default %(default)s')
+    args=parser.parse_args()
+
+    slits=[int(s) for s in args.slits.split(',') if s.strip()]
+    for s in slits:
+        if s not in SLITS:
+            parser.error('Invalid slit {}, valid slits are {}'.format(s,
+                         ','.join(str(x) for x in SLITS)))
+
+    for file in generate(args.name, outdir=args.outdir, setups=args.setups,
+                         targets=args.targets, sky_fraction=args.sky,
+                         slits=slits, preset=args.preset, dead=args.dead,
+                         seed=args.seed):
+        print file